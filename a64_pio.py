@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Memory-mapped Allwinner A64 PIO backend for the PINE100 keyboard matrix.
+#
+# RPi.GPIO costs one library call per pin, so a full scan of the 8x9 matrix is 8 row-high + 72 column reads + 8 row-low
+# = 88 calls.  The A64 keeps the level of every pin on a port in one 32-bit data register, so here a row is driven with a
+# single register write and all nine columns are read with one 32-bit load per port (the Tandy columns sit on ports C
+# and H).  That's 4 memory accesses per row, 32 per scan.
+#
+# Pins are given in BOARD numbering, the same as the rows/cols lists in the layout profiles, and mapped to A64 ports
+# with PI2_PINS below (see PINE64_Pi2_Pinout.png).  The PL pins live in the separate R_PIO block and aren't supported.
+#
+# Needs root for /dev/mem.  Set PINE_PIO_MEM to a plain 4 KiB file to run against a register image instead; the file
+# is mapped from offset 0 with the PIO registers at PIO_OFFSET, just as they sit in the real page.
+#########################################################################################################################
+
+import os
+import mmap
+import logging
+from matrix_gpio import MatrixGPIO, frame_keys
+
+# The PIO block lives at 0x01C20800, inside the page at 0x01C20000
+PIO_PAGE = 0x01C20000
+PIO_OFFSET = 0x800
+
+# Each port has 0x24 bytes of registers: CFG0-3, DAT, DRV0-1, PUL0-1
+PORT_SIZE = 0x24
+CFG_REG = 0x00
+DAT_REG = 0x10
+PUL_REG = 0x1C
+
+CFG_INPUT = 0
+CFG_OUTPUT = 1
+PULL_NONE = 0
+PULL_DOWN = 2
+
+PORTS = "ABCDEFGH"
+
+# Pi-2 bus BOARD pin : (port, pin)
+PI2_PINS = {
+    3:  ("H", 3),    5:  ("H", 2),    8:  ("B", 0),    10: ("B", 1),
+    11: ("C", 7),    12: ("C", 8),    13: ("H", 9),    15: ("C", 12),
+    16: ("C", 13),   18: ("C", 14),   19: ("C", 0),    21: ("C", 1),
+    22: ("C", 15),   23: ("C", 2),    24: ("C", 3),    26: ("H", 7),
+    29: ("H", 5),    31: ("H", 6),    32: ("C", 4),    33: ("C", 5),
+    35: ("C", 9),    36: ("C", 6),    37: ("C", 16),   38: ("C", 10),
+    40: ("C", 11),
+}
+
+# mem_path : {data register index : last value}, see A64PIO.dat
+DAT_CACHES = {}
+
+
+class A64PIO(MatrixGPIO):
+    name = "a64"
+
+    def __init__(self, rows, cols, mem_path = None):
+        super().__init__(rows, cols)
+        # Every pin is looked up before any is configured, so a pin this backend can't drive leaves the others as
+        # they were for the next backend PINE_GPIO=auto tries
+        row_ports = [self.port_pin(row) for row in self.rows]
+        col_ports = [self.port_pin(col) for col in self.cols]
+
+        if mem_path is None:
+            mem_path = os.environ.get("PINE_PIO_MEM", "/dev/mem")
+        map_offset = PIO_PAGE if mem_path == "/dev/mem" else 0
+        logging.info(f"Mapping A64 PIO registers from {mem_path}")
+
+        fd = os.open(mem_path, os.O_RDWR | os.O_SYNC)
+        try:
+            self.mem = mmap.mmap(fd, mmap.PAGESIZE, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE, offset = map_offset)
+        finally:
+            os.close(fd)
+        # Word-indexed view: regs[offset // 4] is one aligned 32-bit load or store
+        self.regs = memoryview(self.mem).cast("I")
+
+        # Last value seen in each port's data register, so a row can be driven with a single write.  Shared by every
+        # matrix mapped from the same file, so driving one matrix's row doesn't put back a stale level on another's.
+        self.dat = DAT_CACHES.setdefault(mem_path, {})
+
+        # Memory accesses made by drive_row()/read_cols(), for comparing against the ~88 calls RPi.GPIO needs per scan
+        self.ops = 0
+
+        # Row i -> (data register index, pin bit)
+        self.row_pins = []
+        # Row mask -> ((data register index, pin bits), ...), filled in by drive_rows()
+        self.row_ports = {}
+        for port, pin in row_ports:
+            self.config_pin(port, pin, CFG_OUTPUT, PULL_NONE)
+            self.row_pins.append((self.dat_index(port), 1 << pin))
+
+        # Group the columns by port.  Each port's data register is turned into column bits with one 256-entry table per
+        # byte that holds a column pin, so no per-column work is done at scan time.
+        banks = {}
+        for j, (port, pin) in enumerate(col_ports):
+            self.config_pin(port, pin, CFG_INPUT, PULL_DOWN)
+            banks.setdefault(self.dat_index(port), []).append((pin, j))
+
+        self.col_banks = []
+        for index, pins in banks.items():
+            tables = []
+            for byte in sorted({pin // 8 for pin, j in pins}):
+                table = [0] * 256
+                for value in range(256):
+                    for pin, j in pins:
+                        if pin // 8 == byte and value & (1 << (pin % 8)):
+                            table[value] |= 1 << j
+                tables.append((byte * 8, table))
+            self.col_banks.append((index, tables))
+
+        for index in {index for index, bit in self.row_pins} | set(banks):
+            self.dat[index] = self.regs[index]
+
+    def port_pin(self, board_pin):
+        if board_pin not in PI2_PINS:
+            raise ValueError(f"BOARD pin {board_pin} is not a main PIO pin on the Pi-2 bus")
+        port, pin = PI2_PINS[board_pin]
+        return PORTS.index(port), pin
+
+    def dat_index(self, port):
+        return (PIO_OFFSET + port * PORT_SIZE + DAT_REG) // 4
+
+    def config_pin(self, port, pin, function, pull):
+        base = PIO_OFFSET + port * PORT_SIZE
+        cfg = (base + CFG_REG) // 4 + pin // 8
+        shift = (pin % 8) * 4
+        self.regs[cfg] = (self.regs[cfg] & ~(0xF << shift)) | (function << shift)
+        pul = (base + PUL_REG) // 4 + pin // 16
+        shift = (pin % 16) * 2
+        self.regs[pul] = (self.regs[pul] & ~(0x3 << shift)) | (pull << shift)
+
+    def drive_row(self, i, level):
+        index, bit = self.row_pins[i]
+        if level:
+            value = self.dat[index] | bit
+        else:
+            value = self.dat[index] & ~bit
+        self.regs[index] = value
+        self.dat[index] = value
+        self.ops += 1
+
+    # One store per port for all the rows in the mask, for probing
+    def drive_rows(self, rows, level):
+        ports = self.row_ports.get(rows)
+        if ports is None:
+            ports = {}
+            for i in frame_keys(rows):
+                index, bit = self.row_pins[i]
+                ports[index] = ports.get(index, 0) | bit
+            ports = self.row_ports[rows] = tuple(ports.items())
+        for index, bits in ports:
+            value = self.dat[index] | bits if level else self.dat[index] & ~bits
+            self.regs[index] = value
+            self.dat[index] = value
+        self.ops += len(ports)
+
+    # One load per column port.  The value read also refreshes the copy drive_row() uses, so other pins on a shared port
+    # keep whatever level they had as of the last scan.
+    def read_cols(self):
+        regs = self.regs
+        bits = 0
+        for index, tables in self.col_banks:
+            value = regs[index]
+            self.dat[index] = value
+            for shift, table in tables:
+                bits |= table[(value >> shift) & 0xFF]
+        self.ops += len(self.col_banks)
+        return bits
+
+    def cleanup(self):
+        self.drive_all_rows(0)
+        self.regs.release()
+        self.mem.close()
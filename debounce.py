@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Per-key debouncing for the PINE100 keyboard matrix.
+#
+# Sits between the raw frames from gpio.scan() and the key handlers: update() takes a raw frame and returns the
+# debounced one, so a contact that chatters for a few milliseconds doesn't turn into extra press/release pairs.  That's
+# what lets the matrix be scanned at 500-1000 Hz instead of hiding bounce behind the slow 1/60 s poll.
+#
+# Pick the algorithm and integration time with PINE_DEBOUNCE=<algorithm>:<milliseconds>, e.g. PINE_DEBOUNCE=eager:5
+#
+#       none    : raw frames go straight through (default)
+#       defer   : a key changes state once its contact has read the new level for the whole integration time.
+#                 Bounce-free both ways, but every press and release is delayed by the integration time.
+#       eager   : a press is reported on the first closed reading, then the key is locked for the integration time;
+#                 a release is reported once the contact has read open for the whole integration time.
+#       counter : per-key integrator counting up on closed readings and down on open ones, the key changes state when
+#                 the count hits either end.  Counts scans rather than time (integration time / scan period).
+#
+# Per-key state is kept in flat arrays indexed by keycode.  Keys that are settling are tracked in the pending bitmask,
+# so a frame where nothing changed and nothing is settling returns after one compare.
+#########################################################################################################################
+
+import os
+import logging
+from array import array
+from math import ceil
+from matrix_gpio import frame_keys
+
+
+class Debouncer:
+    name = None
+
+    def __init__(self, keys, time_ms, scan_period):
+        self.time = time_ms / 1000
+        # Debounced frame
+        self.state = 0
+        # Keys whose contact currently reads differently from state
+        self.pending = 0
+        # Per-key time (monotonic seconds) at which a pending change is accepted, or a lockout ends
+        self.deadline = array("d", [0.0] * keys)
+
+    def update(self, raw, now):
+        raise NotImplementedError
+
+
+# ================= Deferred (symmetric) ===================
+class DeferDebouncer(Debouncer):
+    name = "defer"
+
+    def update(self, raw, now):
+        diff = raw ^ self.state
+        if not diff and not self.pending:
+            return self.state
+
+        deadline = self.deadline
+        # Keys that bounced back to their debounced level stop settling
+        pending = self.pending & diff
+        for keycode in frame_keys(diff & ~pending):
+            deadline[keycode] = now + self.time
+        pending |= diff
+
+        state = self.state
+        for keycode in frame_keys(pending):
+            if now >= deadline[keycode]:
+                state ^= 1 << keycode
+                pending &= ~(1 << keycode)
+
+        self.state = state
+        self.pending = pending
+        return state
+
+
+# ================= Eager press, deferred release ===================
+class EagerDebouncer(Debouncer):
+    name = "eager"
+
+    def update(self, raw, now):
+        diff = raw ^ self.state
+        if not diff and not self.pending:
+            return self.state
+
+        deadline = self.deadline
+        state = self.state
+        pending = self.pending & diff
+
+        for keycode in frame_keys(diff & ~pending):
+            bit = 1 << keycode
+            if raw & bit and now >= deadline[keycode]:
+                # New press outside the lockout: report it now and ignore the contact until it has settled
+                state |= bit
+            else:
+                # Releases, and presses during a lockout, have to hold the new level for the whole time
+                pending |= bit
+            deadline[keycode] = now + self.time
+
+        for keycode in frame_keys(pending):
+            if now >= deadline[keycode]:
+                state ^= 1 << keycode
+                pending &= ~(1 << keycode)
+                # A release also locks the key, so release bounce can't be taken for a fresh press
+                deadline[keycode] = now + self.time
+
+        self.state = state
+        self.pending = pending
+        return state
+
+
+# ================= Counter integration ===================
+class CounterDebouncer(Debouncer):
+    name = "counter"
+
+    def __init__(self, keys, time_ms, scan_period):
+        super().__init__(keys, time_ms, scan_period)
+        self.top = max(1, ceil(self.time / scan_period))
+        self.counts = bytearray(keys)
+
+    def update(self, raw, now):
+        diff = raw ^ self.state
+        if not diff and not self.pending:
+            return self.state
+
+        counts = self.counts
+        top = self.top
+        state = self.state
+        pending = self.pending
+
+        for keycode in frame_keys(diff | pending):
+            bit = 1 << keycode
+            if raw & bit:
+                count = min(counts[keycode] + 1, top)
+            else:
+                count = max(counts[keycode] - 1, 0)
+            counts[keycode] = count
+
+            if count == top:
+                state |= bit
+                pending &= ~bit
+            elif count == 0:
+                state &= ~bit
+                pending &= ~bit
+            else:
+                pending |= bit
+
+        self.state = state
+        self.pending = pending
+        return state
+
+
+ALGORITHMS = {
+    "defer": DeferDebouncer,
+    "eager": EagerDebouncer,
+    "counter": CounterDebouncer,
+}
+
+
+# Build the debouncer named by PINE_DEBOUNCE (or the spec argument), "<algorithm>:<milliseconds>".  Returns None for
+# "none" so the scan loop can skip the stage entirely.
+def open_debouncer(keys, scan_period, spec = None):
+    if spec is None:
+        spec = os.environ.get("PINE_DEBOUNCE", "none")
+    name, _, time_ms = spec.partition(":")
+    if name == "none":
+        return None
+    time_ms = float(time_ms) if time_ms else 5
+    logging.info(f"Debouncing with {name}, {time_ms} ms")
+    return ALGORITHMS[name](keys, time_ms, scan_period)
@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Bounded queue between the scan loop and a separate emitter thread, so writing to /dev/uinput never stretches a scan.
+#
+# The scanner pushes one record per changed key, keycode << 1 | pressed, followed by an end-of-frame marker, into a
+# preallocated ring of 16-bit slots.  The emitter thread drains it, runs the driver's key_pressed()/key_released() for
+# each record and calls ui.syn() once per frame, so a frame's changes still go out as one report.
+#
+# There is one producer and one consumer: only the scanner moves head and only the emitter moves tail, and a frame's
+# records are written before head is moved past them, so neither side takes a lock on the data.  The scanner never
+# waits on the emitter.  If a frame doesn't fit, push() refuses it and counts an overflow, and the scan loop keeps the
+# change pending and offers it again on the next scan, so a stalled emitter delays keys but doesn't lose releases.
+#
+# call() queues a function for the emitter thread to run once everything pushed before it has been handled, so a
+# layout switch or a profile reload takes effect right after the frame that released the keys, never before it.
+#
+# PINE_QUEUE sets the ring size in records (default 256), 0 runs the handlers inline in the scan loop as before.
+# Depth, high-water mark and overflows are in the metrics (keyboard_queue_*).
+#########################################################################################################################
+
+import os
+import logging
+import threading
+from time import sleep
+from array import array
+from collections import deque
+from matrix_gpio import frame_keys
+
+END_OF_FRAME = 0xFFFF
+# Run the next of the functions queued with call()
+CALL = 0xFFFE
+
+
+class EventQueue:
+    def __init__(self, capacity = 256):
+        self.capacity = capacity
+        self.records = array("H", [0] * capacity)
+        # Records ever pushed and ever taken; the slot is the count modulo capacity
+        self.head = 0
+        self.tail = 0
+        self.max_depth = 0
+        self.overflows = 0
+        self.frames = 0
+        self.ready = threading.Event()
+        # Functions queued with call(), one CALL record each
+        self.calls = deque()
+
+    def depth(self):
+        return self.head - self.tail
+
+    # Queue the keys that changed in a frame.  Returns False, and queues nothing, if they don't all fit.
+    def push(self, changed, frame):
+        needed = bin(changed).count("1") + 1
+        depth = self.head - self.tail
+        if depth + needed > self.capacity:
+            self.overflows += 1
+            return False
+
+        records = self.records
+        capacity = self.capacity
+        head = self.head
+        for keycode in frame_keys(changed):
+            records[head % capacity] = keycode << 1 | (frame >> keycode & 1)
+            head += 1
+        records[head % capacity] = END_OF_FRAME
+        head += 1
+
+        # Publish the whole frame at once
+        self.head = head
+        self.frames += 1
+        if head - self.tail > self.max_depth:
+            self.max_depth = head - self.tail
+        self.ready.set()
+        return True
+
+    # Run fn on the emitter thread after everything queued so far.  Waits for room if the ring is full.
+    def call(self, fn):
+        while self.head - self.tail >= self.capacity:
+            sleep(0.001)
+        self.calls.append(fn)
+        self.records[self.head % self.capacity] = CALL
+        self.head += 1
+        self.ready.set()
+
+    # Emitter thread: run the handlers for everything queued, one syn() per frame
+    def drain(self, key_pressed, key_released, syn, metrics = None):
+        records = self.records
+        capacity = self.capacity
+        events = 0
+        while True:
+            self.ready.wait()
+            self.ready.clear()
+            tail = self.tail
+            while tail != self.head:
+                record = records[tail % capacity]
+                try:
+                    if record == END_OF_FRAME:
+                        syn()
+                        if metrics:
+                            metrics.synced(events)
+                        events = 0
+                    elif record == CALL:
+                        self.calls.popleft()()
+                    elif record & 1:
+                        key_pressed(record >> 1)
+                        events += 1
+                    else:
+                        key_released(record >> 1)
+                        events += 1
+                except Exception:
+                    # Keep the keyboard alive: one bad write shouldn't take the emitter thread down with it
+                    logging.exception(f"Emitting queued record {record:#x} failed")
+                tail += 1
+                self.tail = tail
+
+
+# Start the emitter thread if PINE_QUEUE isn't 0 and return its queue, otherwise return None.  keys is the size of the
+# matrix; the ring is always big enough for a frame with every key changed.
+def open_event_queue(keys, key_pressed, key_released, syn, metrics = None):
+    capacity = int(os.environ.get("PINE_QUEUE", 256))
+    if not capacity:
+        return None
+    capacity = max(capacity, keys + 1)
+    logging.info(f"Emitting from a separate thread, {capacity} record queue")
+    queue = EventQueue(capacity)
+    threading.Thread(target = queue.drain, args = (key_pressed, key_released, syn, metrics), daemon = True).start()
+    return queue
@@ -0,0 +1,44 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# A stand-in for the uinput device, for running the driver with no /dev/uinput: kbd_bench.py, kbd_replay.py and
+# kbd_daemon.py --fake-uinput (which kbd_ctl.py --selftest uses).  It records what would have been written, a
+# (type, code, value) tuple per event and None per syn(), and sent_keys() reads back which keys that leaves down.
+#
+# Not needed to run the driver itself; nothing here imports python-evdev.
+#########################################################################################################################
+
+from kbd_engine import Keyboard, load_profile
+
+
+class FakeUInput:
+    def __init__(self):
+        self.events = []
+
+    def write(self, etype, code, value):
+        self.events.append((etype, code, value))
+
+    def syn(self):
+        self.events.append(None)
+
+
+# Key codes a fake uinput device has down from the events written to it, and any pressed again while down (a release
+# that went missing)
+def sent_keys(events):
+    down = set()
+    repeated = set()
+    for event in list(events):
+        if event is None:
+            continue
+        if not event[2]:
+            down.discard(event[1])
+        elif event[1] in down:
+            repeated.add(event[1])
+        else:
+            down.add(event[1])
+    return sorted(down), sorted(repeated)
+
+
+# A fresh keyboard on a fake uinput device, so every run starts with its state reset
+def load_keyboard(path):
+    return Keyboard(load_profile(path), FakeUInput())
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Capture of raw matrix frames to a memory-mapped ring file, for reproducing field bugs with kbd_replay.py.
+#
+# Set PINE_RECORD=/var/tmp/keyboard.frames to turn it on.  Every scan appends its timestamp and the raw frame, before
+# debouncing and ghost filtering, to a fixed-size ring in the file; once it's full the oldest frames are overwritten.
+# PINE_RECORD_FRAMES sets the ring size (default 65536 frames, about 18 minutes at 60 Hz, 1 MiB for the 8x9 matrix).
+#
+# The file is mapped shared, so recording a frame is two stores into the page cache and no syscalls, and what was
+# captured survives the driver crashing.  Copy the file off after the problem shows up.
+#
+# File layout, little-endian:
+#
+#       header (64 bytes)  : magic "PKFR", version, rows, cols, capacity, record size, frames written, scan rate,
+#                            debounce spec and ghost policy the driver ran with
+#       records            : capacity x (u64 monotonic ns, frame as ceil(rows * cols / 8) bytes)
+#
+#   python3 frame_record.py <file>          : print the header and the changed frames
+#########################################################################################################################
+
+import os
+import sys
+import mmap
+import struct
+import logging
+
+MAGIC = b"PKFR"
+VERSION = 1
+HEADER = struct.Struct("<4sHBBIHxxQd16s16s")
+HEADER_SIZE = 64
+# Offset of the frames written counter in the header
+COUNT_OFFSET = 16
+STAMP = struct.Struct("<Q")
+COUNT = struct.Struct("<Q")
+
+
+class FrameRecorder:
+    def __init__(self, path, rows, cols, capacity = 65536, scan_hz = 60, debounce = "none", ghost = "block"):
+        self.frame_bytes = (rows * cols + 7) // 8
+        self.record_size = STAMP.size + self.frame_bytes
+        self.capacity = capacity
+        self.count = 0
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, HEADER_SIZE + capacity * self.record_size)
+            self.map = mmap.mmap(fd, 0, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, rows, cols, capacity, self.record_size, 0, scan_hz,
+                         debounce.encode(), ghost.encode())
+
+    def record(self, ns, frame):
+        offset = HEADER_SIZE + (self.count % self.capacity) * self.record_size
+        STAMP.pack_into(self.map, offset, ns)
+        offset += STAMP.size
+        self.map[offset:offset + self.frame_bytes] = frame.to_bytes(self.frame_bytes, "little")
+        # Counter last, so a reader never sees a slot that's only half written
+        self.count += 1
+        COUNT.pack_into(self.map, COUNT_OFFSET, self.count)
+
+    def close(self):
+        self.map.close()
+
+
+# Read a recording back.  Returns the header as a dict and the frames as (ns, frame) pairs, oldest first.
+def read_frames(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, rows, cols, capacity, record_size, count, scan_hz, debounce, ghost = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a frame recording")
+    header = {
+        "rows": rows,
+        "cols": cols,
+        "capacity": capacity,
+        "frames_written": count,
+        "scan_hz": scan_hz,
+        "debounce": debounce.rstrip(b"\0").decode(),
+        "ghost": ghost.rstrip(b"\0").decode(),
+    }
+
+    frame_bytes = record_size - STAMP.size
+    first = max(0, count - capacity)
+    frames = []
+    for n in range(first, count):
+        offset = HEADER_SIZE + (n % capacity) * record_size
+        ns, = STAMP.unpack_from(data, offset)
+        offset += STAMP.size
+        frames.append((ns, int.from_bytes(data[offset:offset + frame_bytes], "little")))
+    return header, frames
+
+
+# Start recording if PINE_RECORD is set, otherwise return None
+def open_recorder(rows, cols, scan_hz, debounce = None, ghost = None):
+    path = os.environ.get("PINE_RECORD")
+    if not path:
+        return None
+    capacity = int(os.environ.get("PINE_RECORD_FRAMES", 65536))
+    debounce = debounce or os.environ.get("PINE_DEBOUNCE", "none")
+    ghost = ghost or os.environ.get("PINE_GHOST", "block")
+    logging.info(f"Recording raw frames to {path}, {capacity} frame ring")
+    return FrameRecorder(path, rows, cols, capacity, scan_hz, debounce, ghost)
+
+
+if __name__ == "__main__":
+    header, frames = read_frames(sys.argv[1])
+    for name, value in header.items():
+        print(f"{name:15} {value}")
+    print(f"{'frames kept':15} {len(frames)}")
+
+    last = None
+    start = frames[0][0] if frames else 0
+    for ns, frame in frames:
+        if frame != last:
+            keys = [n for n in range(header["rows"] * header["cols"]) if frame >> n & 1]
+            print(f"{(ns - start) / 1e6:12.3f} ms  {keys}")
+            last = frame
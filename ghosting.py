@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Ghost-key detection for the diode-less Tandy matrix.
+#
+# With no diode on each key, three keys held on three corners of a rectangle (two rows, two columns) connect the fourth
+# corner's row and column through the other three, and the scan reads a key that isn't pressed.  Any frame where two
+# rows share two or more closed columns is ambiguous: each of those four corners could be the phantom.
+#
+# filter() takes a (debounced) frame and returns the frame to dispatch.  What happens to ambiguous keys depends on
+# PINE_GHOST:
+#
+#       block           : ambiguous keys can't be newly pressed, but can still be released (default)
+#       last-known-good : ambiguous keys keep whatever state they had in the last accepted frame
+#       report          : pass the frame through unchanged, only count and log the incident
+#       off             : no checking at all
+#
+# Rollover stats are kept as well: ghost_frames, suppressed (presses held back), and rollover[n] counting the accepted
+# frames that had n keys down, so you can see how many keys fast typing and games really hold at once.
+#########################################################################################################################
+
+import os
+import logging
+
+
+class GhostFilter:
+    def __init__(self, rows, cols, policy = "block"):
+        self.rows = rows
+        self.width = cols
+        self.row_mask = (1 << cols) - 1
+        self.policy = policy
+
+        self.last_in = 0
+        self.last_out = 0
+
+        self.ghost_frames = 0
+        self.suppressed = 0
+        self.rollover = [0] * (rows * cols + 1)
+
+    # Every key on a corner of a rectangle of closed keys
+    def ambiguous(self, frame):
+        multi = []
+        for i in range(self.rows):
+            cols = (frame >> (i * self.width)) & self.row_mask
+            # Only rows with two or more keys down can form a rectangle
+            if cols & (cols - 1):
+                multi.append((i * self.width, cols))
+        if len(multi) < 2:
+            return 0
+
+        corners = 0
+        for a in range(len(multi)):
+            shift_a, cols_a = multi[a]
+            for b in range(a + 1, len(multi)):
+                shift_b, cols_b = multi[b]
+                common = cols_a & cols_b
+                if common & (common - 1):
+                    corners |= (common << shift_a) | (common << shift_b)
+        return corners
+
+    def filter(self, frame):
+        if frame == self.last_in:
+            return self.last_out
+        self.last_in = frame
+
+        out = frame
+        corners = self.ambiguous(frame)
+        if corners:
+            self.ghost_frames += 1
+            if self.policy == "block":
+                out = (frame & ~corners) | (self.last_out & frame & corners)
+            elif self.policy == "last-known-good":
+                out = (frame & ~corners) | (self.last_out & corners)
+            held = frame & ~out & ~self.last_out
+            self.suppressed += bin(held).count("1")
+            logging.info(f"Ghosting possible on keys {bin(corners)}, {self.policy} held back {bin(held)}")
+
+        if out != self.last_out:
+            self.rollover[bin(out).count("1")] += 1
+        self.last_out = out
+        return out
+
+    def stats(self):
+        return {
+            "ghost_frames": self.ghost_frames,
+            "suppressed": self.suppressed,
+            "max_rollover": max((n for n in range(len(self.rollover)) if self.rollover[n]), default = 0),
+            "rollover": list(self.rollover),
+        }
+
+
+POLICIES = ("block", "last-known-good", "report")
+
+
+# Build the ghost filter for PINE_GHOST (or the policy argument).  Returns None for "off".
+def open_ghost_filter(rows, cols, policy = None):
+    if policy is None:
+        policy = os.environ.get("PINE_GHOST", "block")
+    if policy == "off":
+        return None
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown ghosting policy {policy}")
+    logging.info(f"Ghost-key policy {policy}")
+    return GhostFilter(rows, cols, policy)
@@ -0,0 +1,334 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Polling governors for the PINE100 keyboard scan loop.
+#
+# After each poll the loop asks the governor how long to sleep before the next one, or whether to go idle (drive every
+# row high and block on a column edge, see matrix_gpio.py).  The scan period comes from a small set of tiers:
+#
+#       fast    : PINE_SCAN_HZ
+#       slow    : 1/10 s
+#       slower  : 1/5 s
+#       idle    : wait for a column edge
+#
+# Pick one with PINE_GOVERNOR:
+#
+#       fixed       : full rate, idle after 10 s with nothing happening
+#       legacy      : the original scripts' thresholds, 1/10 s after 10 s, 1/5 s after 20 s, never idle
+#       performance : adaptive, see below, tuned for latency
+#       balanced    : adaptive (default)
+#       battery     : adaptive, tuned for fewer wakeups
+#
+# The adaptive governors keep an online histogram of the gaps between key activity (log-spaced buckets, newer gaps
+# weighted more) and stay at full rate until the current silence is longer than a profile-chosen quantile of those gaps,
+# so the thinking pauses a given typist actually makes don't drop into a slow tier.  Past that they go idle straight away
+# when the GPIO backend wakes on a column edge (the first key then costs about a millisecond), otherwise they poll at the
+# slow tier for a while first, since the fallback idle wait only polls at 1/5 s.  The thresholds are only recomputed
+# when a key changes, so choosing a period is a couple of compares.
+#
+# The current tier is in governor.tier and governor.stats().  New policies subclass Governor and go in GOVERNORS.
+#
+#   python3 governor.py                     : compare the policies on synthetic typing (a seeded random session)
+#   python3 governor.py a.frames b.frames   : ... on frame recordings made with PINE_RECORD (frame_record.py)
+#   python3 governor.py --no-edge           : assume the idle wait polls at 1/5 s instead of waking on an edge
+#########################################################################################################################
+
+import os
+import logging
+from array import array
+from math import log2
+
+SLOW_PERIOD = 1 / 10
+SLOWER_PERIOD = 1 / 5
+# After this long with nothing happening the fixed governor goes idle
+IDLE_TIME = 10
+
+
+class Governor:
+    name = None
+
+    # edge is True when the idle wait wakes on a column edge (gpio.edge_wait)
+    def __init__(self, scan_hz, edge = True):
+        self.fast = 1 / scan_hz
+        self.edge = edge
+        self.tier = "fast"
+        self.last_activity = None
+
+    # A poll dispatched a key change at time now
+    def activity(self, now):
+        self.last_activity = now
+
+    # Seconds to sleep before the next poll, or None to go idle.  quiet is False while keys are held or settling.
+    def period(self, now, quiet = True):
+        raise NotImplementedError
+
+    def set_tier(self, tier):
+        self.tier = tier
+        return {"fast": self.fast, "slow": SLOW_PERIOD, "slower": SLOWER_PERIOD, "idle": None}[tier]
+
+    def stats(self):
+        return {"governor": self.name, "tier": self.tier}
+
+
+# ================= Fixed thresholds ===================
+class FixedGovernor(Governor):
+    name = "fixed"
+    # (seconds of silence, tier) in increasing order
+    steps = ((IDLE_TIME, "idle"),)
+
+    def period(self, now, quiet = True):
+        tier = "fast"
+        if quiet and self.last_activity is not None:
+            silence = now - self.last_activity
+            for after, step in self.steps:
+                if silence >= after:
+                    tier = step
+        return self.set_tier(tier)
+
+
+class LegacyGovernor(FixedGovernor):
+    name = "legacy"
+    # 600 and 1200 polls at 60 Hz
+    steps = ((10, "slow"), (20, "slower"))
+
+
+# ================= Adaptive ===================
+# Gap histogram buckets: BUCKETS_PER_OCTAVE per doubling from 1 ms
+BUCKETS_PER_OCTAVE = 8
+GAP_BUCKETS = BUCKETS_PER_OCTAVE * 18
+# Each new gap weighs this much more than the one before, so the histogram follows the typist (half-life ~700 gaps)
+GAP_DECAY = 1.001
+# Use the profile's fallback thresholds until this many gaps have been seen
+WARMUP = 50
+
+
+class AdaptiveGovernor(Governor):
+    name = "adaptive"
+    # Gap quantile to stay at full rate for, multiplier on it, and fallback/minimum fast and idle times in seconds
+    quantile = 0.99
+    margin = 1.5
+    min_fast = 1.0
+    idle_after = 10
+
+    def __init__(self, scan_hz, edge = True):
+        super().__init__(scan_hz, edge)
+        self.gaps = array("d", [0.0] * GAP_BUCKETS)
+        self.weight = 1.0
+        self.total = 0.0
+        self.samples = 0
+        # Silence after which to go slow, and then idle
+        self.slow_after = self.min_fast
+        self.idle_at = max(self.idle_after, self.slow_after)
+
+    def activity(self, now):
+        if self.last_activity is not None:
+            gap = now - self.last_activity
+            self.gaps[min(GAP_BUCKETS - 1, max(0, int(BUCKETS_PER_OCTAVE * log2(max(gap, 0.001) * 1000))))] += self.weight
+            self.total += self.weight
+            self.samples += 1
+            self.weight *= GAP_DECAY
+            if self.weight > 1e100:
+                self.rescale()
+            if self.samples >= WARMUP:
+                self.slow_after = max(self.min_fast, self.margin * self.gap_quantile(self.quantile))
+                self.idle_at = max(self.idle_after, 2 * self.slow_after)
+        self.last_activity = now
+
+    def rescale(self):
+        for n in range(GAP_BUCKETS):
+            self.gaps[n] /= self.weight
+        self.total /= self.weight
+        self.weight = 1.0
+
+    # Upper edge of the bucket holding the given fraction of the weighted gaps, in seconds
+    def gap_quantile(self, fraction):
+        target = fraction * self.total
+        total = 0.0
+        for n in range(GAP_BUCKETS):
+            total += self.gaps[n]
+            if total >= target:
+                break
+        return 2 ** ((n + 1) / BUCKETS_PER_OCTAVE) / 1000
+
+    def period(self, now, quiet = True):
+        if not quiet or self.last_activity is None:
+            return self.set_tier("fast")
+        silence = now - self.last_activity
+        if silence < self.slow_after:
+            return self.set_tier("fast")
+        if silence < self.idle_at and not self.edge:
+            return self.set_tier("slow")
+        return self.set_tier("idle")
+
+    def stats(self):
+        stats = super().stats()
+        stats.update(gaps = self.samples, slow_after = self.slow_after, idle_after = self.idle_at)
+        return stats
+
+
+class PerformanceGovernor(AdaptiveGovernor):
+    name = "performance"
+    quantile = 0.999
+    margin = 3.0
+    min_fast = 2.0
+    idle_after = 30
+
+
+class BalancedGovernor(AdaptiveGovernor):
+    name = "balanced"
+
+
+class BatteryGovernor(AdaptiveGovernor):
+    name = "battery"
+    quantile = 0.95
+    margin = 1.0
+    min_fast = 0.5
+    idle_after = 5
+
+
+GOVERNORS = {
+    "fixed": FixedGovernor,
+    "legacy": LegacyGovernor,
+    "performance": PerformanceGovernor,
+    "balanced": BalancedGovernor,
+    "battery": BatteryGovernor,
+}
+
+
+# Build the governor named by PINE_GOVERNOR (or the name argument)
+def open_governor(scan_hz, edge = True, name = None):
+    if name is None:
+        name = os.environ.get("PINE_GOVERNOR", "balanced")
+    if name not in GOVERNORS:
+        raise ValueError(f"Unknown polling governor {name}")
+    logging.info(f"Polling governor {name}")
+    return GOVERNORS[name](scan_hz, edge)
+
+
+# ================= Offline evaluation ===================
+# Silence before a press for it to count as a first key
+FIRST_KEY_GAP = 1.0
+# Time from a column edge to the loop polling, when idle
+EDGE_WAKE = 0.001
+
+
+# Run a governor over a list of (time, pressed) key changes.  Returns wakeups per second, the mean and worst
+# latency of all presses, and the p99 and worst latency of presses after a pause.
+def evaluate(governor, changes, edge = True):
+    t = changes[0][0]
+    end = changes[-1][0]
+    wakeups = 0
+    held = 0
+    latencies = []
+    first_keys = []
+    previous = t
+    n = 0
+
+    while n < len(changes):
+        period = governor.period(t, held == 0)
+        next_change = changes[n][0]
+        if period is None:
+            if edge:
+                t = max(t, next_change + EDGE_WAKE)
+                wakeups += 1
+            else:
+                while t < next_change:
+                    t += SLOWER_PERIOD
+                    wakeups += 1
+        else:
+            t += period
+        # The poll
+        wakeups += 1
+
+        dispatched = False
+        while n < len(changes) and changes[n][0] <= t:
+            when, pressed = changes[n]
+            if pressed:
+                held += 1
+                latencies.append(t - when)
+                if when - previous >= FIRST_KEY_GAP:
+                    first_keys.append(t - when)
+            else:
+                held -= 1
+            previous = when
+            dispatched = True
+            n += 1
+        if dispatched:
+            governor.activity(t)
+
+    first_keys.sort()
+    return {
+        "wakeups_per_s": wakeups / max(end - changes[0][0], 1e-9),
+        "mean_latency": sum(latencies) / len(latencies) if latencies else 0,
+        "max_latency": max(latencies, default = 0),
+        "first_key_p99": first_keys[int(0.99 * (len(first_keys) - 1))] if first_keys else 0,
+        "first_key_max": first_keys[-1] if first_keys else 0,
+    }
+
+
+# A seeded random typing session: words at ~60 wpm, thinking pauses between some words and the odd long break
+def synthetic_changes(minutes, seed):
+    import random
+    rng = random.Random(seed)
+    t = 0.0
+    changes = []
+    while t < minutes * 60:
+        for _ in range(rng.randint(2, 9)):
+            t += rng.lognormvariate(-1.9, 0.5)
+            changes.append((t, True))
+            changes.append((t + rng.uniform(0.05, 0.12), False))
+        t += 0.15
+        r = rng.random()
+        if r < 0.005:
+            t += rng.uniform(20, 300)
+        elif r < 0.12:
+            t += rng.uniform(1, 8)
+    changes.sort()
+    return changes
+
+
+# Key changes in a frame recording, one per key bit that flipped
+def recorded_changes(path):
+    from frame_record import read_frames
+    _, frames = read_frames(path)
+    changes = []
+    last = 0
+    for ns, frame in frames:
+        diff = frame ^ last
+        while diff:
+            bit = diff & -diff
+            changes.append((ns / 1e9, bool(frame & bit)))
+            diff ^= bit
+        last = frame
+    return changes
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description = "Compare polling governors on recorded or synthetic typing")
+    parser.add_argument("recordings", nargs = "*", help = "frame recordings (default: a synthetic session)")
+    parser.add_argument("--minutes", type = float, default = 60, help = "length of the synthetic session")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--scan-hz", type = float, default = 60)
+    parser.add_argument("--no-edge", action = "store_true", help = "idle waits poll at 1/5 s")
+    args = parser.parse_args()
+
+    traces = [(path, recorded_changes(path)) for path in args.recordings]
+    if not traces:
+        traces = [(f"synthetic {args.minutes:g} min, seed {args.seed}", synthetic_changes(args.minutes, args.seed))]
+
+    for label, changes in traces:
+        if not changes:
+            print(f"{label}: no key changes")
+            continue
+        print(label)
+        print(f"  {'governor':12} {'wakeups/s':>9} {'mean ms':>8} {'max ms':>8} {'first p99':>9} {'first max':>9}")
+        for name, governor in GOVERNORS.items():
+            result = evaluate(governor(args.scan_hz, not args.no_edge), changes, not args.no_edge)
+            print(f"  {name:12} {result['wakeups_per_s']:9.2f} {result['mean_latency'] * 1000:8.2f} "
+                  f"{result['max_latency'] * 1000:8.2f} {result['first_key_p99'] * 1000:9.2f} "
+                  f"{result['first_key_max'] * 1000:9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Compare the GPIO backends in matrix_gpio.py on this board.  Each backend that can be opened does a number of full
+# 8x9 matrix scans with nothing pressed, and the report shows scans per second, per-scan p50/p99 time and hardware
+# operations per scan.  Backends that can't be opened here (no RPi.GPIO, no root for /dev/mem...) are listed and skipped.
+# Each is timed twice: reading every row, and with the idle probe the scan loop uses (scan_changed(), one read of the
+# columns with every row driven).  kbd_bench.py compares the two while typing, on the simulated matrix.
+#
+#   python3 gpio_bench.py                   : every backend
+#   python3 gpio_bench.py cdev a64          : just these
+#   python3 gpio_bench.py --scans 20000     : more scans per backend (default 5000)
+#########################################################################################################################
+
+import argparse
+from time import perf_counter_ns
+from matrix_gpio import BACKENDS, open_gpio
+
+# Tandy 102 pin map, as in the layout profiles
+cols = [11,12,13,15,16,18,19,21,22]
+rows = [23,29,31,32,33,35,36,37]
+
+
+def percentile(ordered, fraction):
+    return ordered[int(fraction * (len(ordered) - 1))]
+
+
+def bench(gpio, scans, scan):
+    # A few untimed scans first so lazy setup and cold caches don't land in the numbers
+    for _ in range(10):
+        scan()
+
+    ops = gpio.ops
+    times = [0] * scans
+    start = perf_counter_ns()
+    for n in range(scans):
+        t = perf_counter_ns()
+        scan()
+        times[n] = perf_counter_ns() - t
+    total = perf_counter_ns() - start
+    ops = (gpio.ops - ops) / scans
+
+    times.sort()
+    return scans * 1e9 / total, percentile(times, 0.50) / 1000, percentile(times, 0.99) / 1000, ops
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark full matrix scans on each GPIO backend")
+    parser.add_argument("backends", nargs = "*", default = list(BACKENDS), help = "backends to run (default: all)")
+    parser.add_argument("--scans", type = int, default = 5000, help = "timed scans per backend")
+    args = parser.parse_args()
+
+    print(f"{'backend':8} {'scan':6} {'scans/s':>10} {'p50 us':>9} {'p99 us':>9} {'ops/scan':>9}")
+    for name in args.backends:
+        try:
+            gpio = open_gpio(rows, cols, name)
+        except (ImportError, OSError, RuntimeError) as err:
+            print(f"{name:8} unavailable: {err}")
+            continue
+        try:
+            for strategy, scan in (("full", gpio.scan), ("probe", lambda: gpio.scan_changed(0))):
+                rate, p50, p99, ops = bench(gpio, args.scans, scan)
+                print(f"{name:8} {strategy:6} {rate:10.0f} {p50:9.1f} {p99:9.1f} {ops:9.0f}")
+        finally:
+            gpio.cleanup()
+
+
+if __name__ == "__main__":
+    main()
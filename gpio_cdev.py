@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# GPIO character-device backend for the PINE100 keyboard matrix (/dev/gpiochipN, the interface libgpiod is built on).
+#
+# RPi.GPIO on Armbian is a compatibility shim and every GPIO.input() is its own syscall, about 88 per scan.  Here the 8
+# row lines and the 9 column lines are requested as two bulk line handles, so driving a row is one set-values ioctl on
+# the row group and reading every column is one get-values ioctl on the column group: 16 syscalls for a full scan.
+#
+# To keep it at 16, dropping a row low is held back and folded into the write that raises the next row.  The last row of
+# a scan stays driven until the next scan starts; the columns are pulled down so that's harmless.
+#
+# While idle the column handle is swapped for rising-edge event lines and the driver blocks in select() on them, and
+# on a pipe that interrupt() writes to when another matrix's wait has already woken.
+#
+# Pins are given in BOARD numbering and mapped to line offsets of the main A64 pin controller (port * 32 + pin), using
+# the Pi-2 bus table in a64_pio.py.  Set PINE_GPIOCHIP to use a chip other than /dev/gpiochip0.
+#
+# Run this file directly to count the syscalls a full scan takes on the Tandy 102 pin map.
+#########################################################################################################################
+
+import os
+import fcntl
+import select
+import struct
+import logging
+from matrix_gpio import MatrixGPIO, frame_keys
+from a64_pio import PI2_PINS, PORTS
+
+# GPIO uAPI v1 (linux/gpio.h)
+GPIOHANDLES_MAX = 64
+
+GPIOHANDLE_REQUEST_INPUT = 1 << 0
+GPIOHANDLE_REQUEST_OUTPUT = 1 << 1
+GPIOHANDLE_REQUEST_BIAS_PULL_DOWN = 1 << 6
+GPIOEVENT_REQUEST_RISING_EDGE = 1 << 0
+
+# struct gpiohandle_request { u32 lineoffsets[64]; u32 flags; u8 default_values[64]; char consumer_label[32]; u32 lines; int fd; }
+HANDLE_REQUEST = struct.Struct(f"{GPIOHANDLES_MAX}II{GPIOHANDLES_MAX}s32sIi")
+# struct gpioevent_request { u32 lineoffset; u32 handleflags; u32 eventflags; char consumer_label[32]; int fd; }
+EVENT_REQUEST = struct.Struct("III32si")
+# struct gpioevent_data { u64 timestamp; u32 id; }
+EVENT_DATA_SIZE = 16
+
+
+def _IOWR(nr, size):
+    return (3 << 30) | (size << 16) | (0xB4 << 8) | nr
+
+GPIO_GET_LINEHANDLE_IOCTL = _IOWR(0x03, HANDLE_REQUEST.size)
+GPIO_GET_LINEEVENT_IOCTL = _IOWR(0x04, EVENT_REQUEST.size)
+GPIOHANDLE_GET_LINE_VALUES_IOCTL = _IOWR(0x08, GPIOHANDLES_MAX)
+GPIOHANDLE_SET_LINE_VALUES_IOCTL = _IOWR(0x09, GPIOHANDLES_MAX)
+
+CONSUMER = b"pine100-keyboard"
+
+# Maps 0/1 bytes to ASCII digits so a row of line values can be turned into a bitmask by int(..., 2)
+DIGITS = bytes.maketrans(b"\x00\x01", b"01")
+
+
+def line_offset(board_pin):
+    if board_pin not in PI2_PINS:
+        raise ValueError(f"BOARD pin {board_pin} is not a main PIO pin on the Pi-2 bus")
+    port, pin = PI2_PINS[board_pin]
+    return PORTS.index(port) * 32 + pin
+
+
+class CdevGPIO(MatrixGPIO):
+    name = "cdev"
+    edge_wait = True
+
+    def __init__(self, rows, cols, chip = None):
+        super().__init__(rows, cols)
+
+        # Looked up before the chip is opened, so a pin this backend can't drive leaves nothing open
+        self.row_lines = [line_offset(row) for row in self.rows]
+        self.col_lines = [line_offset(col) for col in self.cols]
+
+        if chip is None:
+            chip = os.environ.get("PINE_GPIOCHIP", "/dev/gpiochip0")
+        logging.info(f"Requesting matrix lines from {chip}")
+        self.chip_fd = os.open(chip, os.O_RDWR)
+
+        # Preallocated ioctl buffers, updated in place by the kernel
+        self.row_values = bytearray(GPIOHANDLES_MAX)
+        self.col_values = bytearray(GPIOHANDLES_MAX)
+        self.row_pending = False
+
+        # Syscalls made by drive_row()/read_cols()
+        self.ops = 0
+
+        # interrupt() writes a byte here to end a wait_for_keypress() on another thread
+        self.wake_fd, self.wake_write_fd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+
+        # Give back whatever was already requested if a line is busy, so the next backend PINE_GPIO=auto tries can
+        # have the rows
+        opened = [self.chip_fd, self.wake_fd, self.wake_write_fd]
+        try:
+            self.row_fd = self.request_lines(self.row_lines, GPIOHANDLE_REQUEST_OUTPUT)
+            opened.append(self.row_fd)
+            self.col_fd = self.request_lines(self.col_lines,
+                                             GPIOHANDLE_REQUEST_INPUT | GPIOHANDLE_REQUEST_BIAS_PULL_DOWN)
+        except OSError:
+            for fd in opened:
+                os.close(fd)
+            raise
+
+    def request_lines(self, lines, flags):
+        offsets = list(lines) + [0] * (GPIOHANDLES_MAX - len(lines))
+        request = bytearray(HANDLE_REQUEST.pack(*offsets, flags, bytes(GPIOHANDLES_MAX), CONSUMER, len(lines), 0))
+        fcntl.ioctl(self.chip_fd, GPIO_GET_LINEHANDLE_IOCTL, request, True)
+        return HANDLE_REQUEST.unpack(request)[-1]
+
+    def flush_rows(self):
+        fcntl.ioctl(self.row_fd, GPIOHANDLE_SET_LINE_VALUES_IOCTL, self.row_values, True)
+        self.row_pending = False
+        self.ops += 1
+
+    def drive_row(self, i, level):
+        self.row_values[i] = 1 if level else 0
+        if level:
+            self.flush_rows()
+        else:
+            self.row_pending = True
+
+    def drive_all_rows(self, level):
+        for i in range(len(self.rows)):
+            self.row_values[i] = 1 if level else 0
+        self.flush_rows()
+
+    # All of them in one syscall, deferred like drive_row() when letting go
+    def drive_rows(self, rows, level):
+        for i in frame_keys(rows):
+            self.row_values[i] = 1 if level else 0
+        if level:
+            self.flush_rows()
+        else:
+            self.row_pending = True
+
+    def read_cols(self):
+        if self.row_pending:
+            self.flush_rows()
+        fcntl.ioctl(self.col_fd, GPIOHANDLE_GET_LINE_VALUES_IOCTL, self.col_values, True)
+        self.ops += 1
+        return int(self.col_values[len(self.cols) - 1::-1].translate(DIGITS), 2)
+
+    # The column lines can't be held by a line handle and an event request at the same time, so the handle is given
+    # back for the duration of the wait and requested again afterwards.
+    def wait_for_keypress(self, timeout = None, woke = None):
+        self.drain_wakes()
+        self.drive_all_rows(1)
+        os.close(self.col_fd)
+        event_fds = []
+        try:
+            for line in self.col_lines:
+                request = bytearray(EVENT_REQUEST.pack(line, GPIOHANDLE_REQUEST_INPUT | GPIOHANDLE_REQUEST_BIAS_PULL_DOWN,
+                                                       GPIOEVENT_REQUEST_RISING_EDGE, CONSUMER, 0))
+                fcntl.ioctl(self.chip_fd, GPIO_GET_LINEEVENT_IOCTL, request, True)
+                event_fds.append(EVENT_REQUEST.unpack(request)[-1])
+
+            # A key that closed before the edges were armed would never raise an event
+            for fd in event_fds:
+                fcntl.ioctl(fd, GPIOHANDLE_GET_LINE_VALUES_IOCTL, self.col_values, True)
+                if self.col_values[0]:
+                    if woke:
+                        woke.set()
+                    return True
+            # Another matrix woke while the events were being armed; one that wakes from here on writes to the pipe
+            if woke and woke.is_set():
+                return False
+
+            ready, _, _ = select.select(event_fds + [self.wake_fd], [], [], timeout)
+            keys = False
+            for fd in ready:
+                if fd != self.wake_fd:
+                    os.read(fd, EVENT_DATA_SIZE)
+                    keys = True
+            if keys and woke:
+                woke.set()
+            return keys
+        finally:
+            for fd in event_fds:
+                os.close(fd)
+            self.col_fd = self.request_lines(self.col_lines,
+                                             GPIOHANDLE_REQUEST_INPUT | GPIOHANDLE_REQUEST_BIAS_PULL_DOWN)
+            self.drive_all_rows(0)
+
+    def interrupt(self):
+        os.write(self.wake_write_fd, b"\0")
+
+    def drain_wakes(self):
+        try:
+            while os.read(self.wake_fd, 64):
+                pass
+        except BlockingIOError:
+            pass
+
+    def cleanup(self):
+        self.drive_all_rows(0)
+        os.close(self.wake_fd)
+        os.close(self.wake_write_fd)
+        os.close(self.row_fd)
+        os.close(self.col_fd)
+        os.close(self.chip_fd)
+
+
+if __name__ == "__main__":
+    # Tandy 102 pin map, as in the layout profiles
+    gpio = CdevGPIO([23,29,31,32,33,35,36,37], [11,12,13,15,16,18,19,21,22])
+    gpio.ops = 0
+    for i in range(len(gpio.rows)):
+        gpio.drive_row(i, 1)
+        gpio.read_cols()
+        gpio.drive_row(i, 0)
+    print(f"Full {len(gpio.rows)}-row scan: {gpio.ops} syscalls")
+    gpio.cleanup()
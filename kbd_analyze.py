@@ -0,0 +1,340 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Offline analysis of captured keyboard traces, for switch health and latency across many recordings.
+#
+# Takes any number of raw frame recordings (PINE_RECORD, frame_record.py) and event traces (PINE_TRACE, kbd_trace.py),
+# told apart by their magic, and reports over all of them:
+#
+#       per key     : presses, chatter (presses held, or coming after a release, for less than --bounce ms, 5 by
+#                     default, as a share of presses), hold time p50/p90/p99
+#       histograms  : hold times, intervals between consecutive presses of any key, and the scan interval (p50, p99 and
+#                     their difference as the scan jitter, idle waits left out)
+#       ghosting    : frames entered with two rows sharing two closed columns, and the keys on those rectangles
+#
+# Bounces and ghosting need the raw frames; an event trace has already been through the driver's debouncer and ghost
+# filter, so it mostly adds presses and hold times, and which key codes were sent.
+#
+# Files are mapped with numpy.memmap, not read, and frames are handled a chunk at a time: comparing each frame with the
+# one before it is one vectorised pass over the chunk, and only the frames that changed are unpacked into key bits.
+# Key transitions from every file then go through one sort and a few array passes, so the cost is the size of the
+# recordings plus the number of keystrokes, with no Python loop per frame or per event.
+#
+# Matrix positions are named from a layout profile's base layer, or as r<row>c<col> without one.  Needs NumPy.
+#
+#   python3 kbd_analyze.py /var/tmp/keyboard.frames --profile /etc/keyboard.json
+#   python3 kbd_analyze.py captures/*.frames captures/*.trace --json health.json
+#########################################################################################################################
+
+import sys
+import json
+import argparse
+import numpy as np
+from frame_record import MAGIC as FRAMES_MAGIC, HEADER as FRAMES_HEADER, HEADER_SIZE, STAMP
+from kbd_trace import MAGIC as TRACE_MAGIC, HEADER as TRACE_HEADER, PRESS, RELEASE
+from kbd_metrics import SCAN_BUCKETS
+
+# Frames per vectorised pass
+CHUNK = 1 << 20
+# A gap between scans longer than this was an idle wait, not a slow scan
+IDLE_GAP_NS = 1_000_000_000
+BOUNCE_MS = 5
+# Histogram bucket upper bounds in ms, for hold times and intervals between presses
+MS_BUCKETS = (5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+# ================= Loading ===================
+# The records of a frame recording, oldest first, as memmap views: one, or two when the ring has wrapped
+def frame_records(path):
+    with open(path, "rb") as f:
+        magic, version, rows, cols, capacity, record_size, count, scan_hz, debounce, ghost = \
+            FRAMES_HEADER.unpack(f.read(FRAMES_HEADER.size))
+    frame_bytes = record_size - STAMP.size
+    dtype = np.dtype([("ns", "<u8"), ("frame", "u1", (frame_bytes,))])
+    records = np.memmap(path, dtype, "r", offset = HEADER_SIZE, shape = (capacity,))
+    if count <= capacity:
+        parts = [records[:count]]
+    else:
+        parts = [records[count % capacity:], records[:count % capacity]]
+    return {"rows": rows, "cols": cols, "scan_hz": scan_hz, "frames": min(count, capacity)}, parts
+
+
+def chunks(parts):
+    for part in parts:
+        for start in range(0, len(part), CHUNK):
+            yield part[start:start + CHUNK]
+
+
+# PRESS/RELEASE records of an event trace as (ns, keycode, pressed, code) arrays
+def trace_events(path):
+    with open(path, "rb") as f:
+        magic, version, entries = TRACE_HEADER.unpack(f.read(TRACE_HEADER.size))
+    records = np.memmap(path, np.dtype([("ns", "<u8"), ("record", "<u8")]), "r", offset = TRACE_HEADER.size,
+                        shape = (entries,))
+    kind = records["record"] & 0xFF
+    keys = (kind == PRESS) | (kind == RELEASE)
+    record = records["record"][keys]
+    return (records["ns"][keys].astype(np.int64), (record >> 8 & 0xFF).astype(np.int64), kind[keys] == PRESS,
+            (record >> 32 & 0xFFFF).astype(np.int64))
+
+
+def file_kind(path):
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic == FRAMES_MAGIC:
+        return "frames"
+    if magic == TRACE_MAGIC:
+        return "trace"
+    raise ValueError(f"{path} is neither a frame recording nor a keyboard trace")
+
+
+# For (frames, rows, cols) key bits, the keys that are corners of a rectangle: on a row that shares two or more closed
+# columns with another row, in one of those columns (ghosting.ambiguous() for a single frame)
+def rectangles(grid):
+    rows = grid.shape[1]
+    bits = grid.astype(np.int16)
+    # shared[m, a, b] is the number of columns closed on both rows a and b
+    shared = np.einsum("mac,mbc->mab", bits, bits)
+    shared[:, np.arange(rows), np.arange(rows)] = 0
+    pairs = shared >= 2
+    return grid & (pairs[:, :, :, None] & grid[:, None, :, :]).any(axis = 2)
+
+
+# ================= Analysis ===================
+class Analysis:
+    def __init__(self, bounce_ms = BOUNCE_MS):
+        self.bounce_ns = bounce_ms * 1_000_000
+        self.rows = self.cols = None
+        self.files = {"frames": 0, "trace": 0}
+        self.frames = 0
+        self.seconds = 0.0
+        # Key transitions from every file: time, source file, key, True for a press
+        self.edges = []
+        self.sent = np.zeros(0x10000, np.int64)
+        self.intervals = np.zeros(len(SCAN_BUCKETS) + 1, np.int64)
+        self.interval_samples = []
+        self.ghost_frames = 0
+        self.ghost_keys = None
+
+    def geometry(self, rows, cols):
+        if self.rows is None:
+            self.rows, self.cols = rows, cols
+            self.ghost_keys = np.zeros(rows * cols, np.int64)
+        elif (rows, cols) != (self.rows, self.cols):
+            raise ValueError(f"Recordings of a {rows}x{cols} and a {self.rows}x{self.cols} matrix can't be mixed")
+
+    def add_frames(self, path):
+        header, parts = frame_records(path)
+        rows, cols = header["rows"], header["cols"]
+        self.geometry(rows, cols)
+        keys = rows * cols
+        source = sum(self.files.values())
+        self.files["frames"] += 1
+        self.frames += header["frames"]
+
+        last_ns = last_frame = None
+        for chunk in chunks(parts):
+            ns = chunk["ns"].astype(np.int64)
+            frame = chunk["frame"]
+            if last_ns is None:
+                # The first frame is compared with an empty matrix, so keys already down count from there
+                last_ns, last_frame = ns[0], np.zeros_like(frame[0])
+
+            gaps = np.diff(ns, prepend = last_ns)
+            scans = gaps[(gaps > 0) & (gaps < IDLE_GAP_NS)]
+            self.seconds += gaps[gaps < IDLE_GAP_NS].sum() / 1e9
+            np.add.at(self.intervals, np.searchsorted(SCAN_BUCKETS, scans), 1)
+            # A sample for the percentiles, so a month of scans isn't all kept
+            self.interval_samples.append(scans[::max(1, len(scans) // 10000)])
+
+            before = np.concatenate((last_frame[None], frame[:-1]))
+            changed = np.flatnonzero((frame != before).any(axis = 1))
+            last_ns, last_frame = ns[-1], frame[-1]
+            if not len(changed):
+                continue
+
+            new = np.unpackbits(frame[changed], axis = 1, bitorder = "little")[:, :keys].astype(bool)
+            old = np.unpackbits(before[changed], axis = 1, bitorder = "little")[:, :keys].astype(bool)
+            which, key = np.nonzero(new != old)
+            self.edges.append((ns[changed][which], np.full(len(key), source), key, new[which, key]))
+            self.ghosting(new, old)
+
+    # Count the frames entered with a rectangle of closed keys, and which keys were on its corners.  A rectangle takes
+    # four keys, so only frames with that many down are looked at.
+    def ghosting(self, new, old):
+        many = np.flatnonzero(new.sum(axis = 1) >= 4)
+        if not len(many):
+            return
+        shape = (-1, self.rows, self.cols)
+        corners = rectangles(new[many].reshape(shape))
+        entered = corners.any(axis = (1, 2)) & ~rectangles(old[many].reshape(shape)).any(axis = (1, 2))
+        self.ghost_frames += int(entered.sum())
+        self.ghost_keys += corners[entered].reshape(-1, self.rows * self.cols).sum(axis = 0)
+
+    def add_trace(self, path):
+        ns, key, pressed, code = trace_events(path)
+        source = sum(self.files.values())
+        self.files["trace"] += 1
+        self.edges.append((ns, np.full(len(key), source), key, pressed))
+        np.add.at(self.sent, code[pressed], 1)
+
+    def report(self, names):
+        if self.edges:
+            ns, source, key, pressed = (np.concatenate(column) for column in zip(*self.edges))
+        else:
+            ns = source = key = np.zeros(0, np.int64)
+            pressed = np.zeros(0, bool)
+        # Traces alone don't give the matrix size
+        keys = self.rows * self.cols if self.rows else int(key.max(initial = -1)) + 1
+        order = np.lexsort((ns, key, source))
+        ns, source, key, pressed = ns[order], source[order], key[order], pressed[order]
+
+        # Consecutive transitions of the same key in the same file: press then release is a hold, release then press
+        # is a gap.  A press after a gap shorter than the bounce time, or held for less than it, is chatter.
+        same = (key[1:] == key[:-1]) & (source[1:] == source[:-1])
+        spans = ns[1:] - ns[:-1]
+        held = same & pressed[:-1] & ~pressed[1:]
+        gap = same & ~pressed[:-1] & pressed[1:]
+        holds, hold_keys = spans[held], key[:-1][held]
+        short = spans < self.bounce_ns
+        bounced = np.zeros(len(ns), bool)
+        bounced[:-1] |= held & short
+        bounced[1:] |= gap & short
+
+        presses = np.bincount(key[pressed], minlength = keys)
+        chatter = np.bincount(key[bounced], minlength = keys)
+        # Hold time percentiles per key, from one sort of every hold by key and then by length
+        by_key = np.lexsort((holds, hold_keys))
+        holds_sorted, keys_sorted = holds[by_key], hold_keys[by_key]
+        starts = np.searchsorted(keys_sorted, np.arange(keys))
+        counts = np.bincount(keys_sorted, minlength = keys)
+
+        per_key = []
+        for k in np.flatnonzero(presses)[np.argsort(-presses[presses > 0], kind = "stable")]:
+            entry = {"key": names(k), "keycode": int(k), "presses": int(presses[k]), "chatter": int(chatter[k]),
+                     "chatter_rate": float(chatter[k] / presses[k])}
+            if counts[k]:
+                key_holds = holds_sorted[starts[k]:starts[k] + counts[k]]
+                for p in (50, 90, 99):
+                    entry[f"hold_p{p}_ms"] = float(key_holds[min(len(key_holds) - 1, len(key_holds) * p // 100)] / 1e6)
+            per_key.append(entry)
+
+        press_ns, press_source = ns[pressed], source[pressed]
+        by_time = np.lexsort((press_ns, press_source))
+        press_ns, press_source = press_ns[by_time], press_source[by_time]
+        between = np.diff(press_ns)[press_source[1:] == press_source[:-1]]
+
+        samples = np.concatenate(self.interval_samples) if self.interval_samples else np.zeros(0, np.int64)
+        scan = {"histogram": histogram(self.intervals, [bound / 1e6 for bound in SCAN_BUCKETS])}
+        if len(samples):
+            p50, p99 = np.percentile(samples, (50, 99)) / 1e6
+            scan.update(p50_ms = float(p50), p99_ms = float(p99), jitter_ms = float(p99 - p50))
+
+        return {
+            "files": self.files,
+            "frames": self.frames,
+            "scanning_hours": self.seconds / 3600,
+            "presses": int(presses.sum()),
+            "chatter": int(chatter.sum()),
+            "keys": per_key,
+            "hold_ms": histogram(bucket(holds), MS_BUCKETS),
+            "between_presses_ms": histogram(bucket(between), MS_BUCKETS),
+            "scan_interval_ms": scan,
+            "ghosting": {"frames": self.ghost_frames,
+                         "keys": {names(k): int(n) for k, n in enumerate(self.ghost_keys if self.ghost_keys is not None
+                                                                         else []) if n}},
+            "sent": {names(code, sent = True): int(self.sent[code]) for code in np.flatnonzero(self.sent)},
+        }
+
+
+def bucket(ns):
+    return np.bincount(np.searchsorted(MS_BUCKETS, ns / 1e6), minlength = len(MS_BUCKETS) + 1)
+
+
+# {"<= bound": count, ..., "> last": count}
+def histogram(counts, bounds):
+    labels = [f"<= {bound:g}" for bound in bounds] + [f"> {bounds[-1]:g}"]
+    return dict(zip(labels, (int(count) for count in counts)))
+
+
+# ================= Output ===================
+def print_histogram(title, counts):
+    total = sum(counts.values()) or 1
+    print(f"\n{title}")
+    for label, count in counts.items():
+        print(f"  {label:>10}  {count:10}  {'#' * round(40 * count / total)}")
+
+
+def print_report(result):
+    files = result["files"]
+    print(f"{files['frames']} frame recordings ({result['frames']} frames, {result['scanning_hours']:.1f} h scanning), "
+          f"{files['trace']} event traces")
+    print(f"{result['presses']} presses, {result['chatter']} chattered")
+
+    print(f"\n{'key':14} {'presses':>9} {'chatter':>8} {'rate':>7} {'hold p50':>9} {'p90':>7} {'p99':>7}")
+    for entry in result["keys"]:
+        line = f"{entry['key']:14} {entry['presses']:9} {entry['chatter']:8} {entry['chatter_rate']:7.2%}"
+        if "hold_p50_ms" in entry:
+            line += f" {entry['hold_p50_ms']:9.0f} {entry['hold_p90_ms']:7.0f} {entry['hold_p99_ms']:7.0f}"
+        print(line)
+
+    print_histogram("Hold time (ms)", result["hold_ms"])
+    print_histogram("Between presses (ms)", result["between_presses_ms"])
+    scan = result["scan_interval_ms"]
+    print_histogram("Scan interval (ms)", scan["histogram"])
+    if "p50_ms" in scan:
+        print(f"  p50 {scan['p50_ms']:.2f} ms, p99 {scan['p99_ms']:.2f} ms, jitter {scan['jitter_ms']:.2f} ms")
+
+    ghosting = result["ghosting"]
+    print(f"\nGhosting: {ghosting['frames']} frames with a possible ghost key")
+    for name, count in sorted(ghosting["keys"].items(), key = lambda item: -item[1]):
+        print(f"  {name:14} {count}")
+    if result["sent"]:
+        print("\nSent (event traces):")
+        for name, count in sorted(result["sent"].items(), key = lambda item: -item[1]):
+            print(f"  {name:14} {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Key health and scan timing from frame recordings and key traces")
+    parser.add_argument("files", nargs = "+", help = "PINE_RECORD frame recordings and/or PINE_TRACE dumps")
+    parser.add_argument("--profile", help = "layout profile, to name the keys")
+    parser.add_argument("--bounce", type = float, default = BOUNCE_MS,
+                        help = f"ms within which a key going back counts as chatter (default {BOUNCE_MS})")
+    parser.add_argument("--json", help = "also write the results to this file")
+    args = parser.parse_args()
+
+    profile = None
+    if args.profile:
+        from kbd_engine import load_profile
+        profile = load_profile(args.profile)
+
+    analysis = Analysis(args.bounce)
+    try:
+        for path in args.files:
+            if file_kind(path) == "frames":
+                analysis.add_frames(path)
+            else:
+                analysis.add_trace(path)
+    except (OSError, ValueError) as err:
+        sys.exit(str(err))
+
+    cols = analysis.cols or (len(profile.cols) if profile else 9)
+
+    def names(n, sent = False):
+        n = int(n)
+        if sent:
+            return profile.names.get(n, str(n)) if profile else str(n)
+        if profile and n < profile.keys:
+            return profile.names.get(profile.base[n], str(n))
+        return f"r{n // cols}c{n % cols}"
+
+    result = analysis.report(names)
+    print_report(result)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent = 2)
+
+
+if __name__ == "__main__":
+    main()
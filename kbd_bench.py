@@ -0,0 +1,339 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Hardware-free benchmark for the PINE100 keyboard profiles.
+#
+# Each layout profile is loaded into the driver engine (kbd_engine.py) and its key_pressed()/key_released() handlers
+# are run through the real MatrixScanner against the simulated matrix in matrix_gpio.py and a fake UInput that just
+# records what would have been written.  Scripted typing traces are replayed one scan at a time
+# with no sleeping, so the numbers are pure scan + dispatch cost:
+#
+#       scans/s     : polls per second of CPU the loop could sustain
+#       events/s    : ui.write() calls per second
+#       us/key      : CPU time per keystroke in the trace, including the scans between keystrokes
+#       blocks/scan : net memory blocks still allocated afterwards, per scan (should be ~0)
+#       gc/1k       : generation-0 garbage collections per 1000 scans, a rough measure of allocation churn
+#       full ops    : simulated GPIO operations per scan (pin calls, as RPi.GPIO counts them) scanning every row
+#       probe ops   : the same with the probe scan (matrix_gpio.scan_changed(), PINE_PROBE), which the loop uses
+#
+#   python3 kbd_bench.py                          : every profile, every trace
+#   python3 kbd_bench.py -t burst -t combos       : just these traces
+#   python3 kbd_bench.py --json results.json      : also save the numbers, to compare before a deploy
+#   python3 kbd_bench.py --debounce               : check each debounce algorithm against taps with contact bounce
+#
+# --debounce runs the bounce trace, where every press and release chatters for a few scans before it settles, through
+# the scanner with each PINE_DEBOUNCE algorithm at 5 ms.  It prints presses and releases sent and the mean latency from
+# the first closed (or open) reading to the event, and fails unless unfiltered scanning shows the chatter and defer,
+# eager and counter each send exactly one press and one release per tap, with eager pressing first.
+#
+# PINE_DEBOUNCE and PINE_GHOST are honoured, so the same traces can be rerun with the filters on.  Needs python-evdev
+# to compile a profile that isn't in the cache yet.
+#########################################################################################################################
+
+import gc
+import sys
+import json
+import logging
+import argparse
+from time import perf_counter, process_time
+from matrix_gpio import SimGPIO
+from matrix_scan import MatrixScanner
+from fake_uinput import load_keyboard
+
+PROFILES = [
+    "profiles/keyboard_100.json",
+    "profiles/keyboard_102.json",
+    "profiles/keyboard_102_modded_capslock_numlock.json",
+    "profiles/keyboard_102_modded_capslock_numlock_with_CODE.json",
+    "profiles/keyboard_102_modded_capsnumkeys_repositioned_function_keys.json",
+]
+
+# Scan value of each key, the same positions in every keymap
+KEYS = {
+    "z": 0,  "a": 1,  "q": 2,  "o": 3,  "1": 4,  "9": 5,  " ": 6,
+    "x": 9,  "s": 10, "w": 11, "p": 12, "2": 13, "0": 14, "\b": 15,
+    "c": 18, "d": 19, "e": 20, "[": 21, "3": 22, "-": 23, "\t": 24,
+    "v": 27, "f": 28, "r": 29, ";": 30, "4": 31, "=": 32,
+    "b": 36, "g": 37, "t": 38, "'": 39, "5": 40,
+    "n": 45, "h": 46, "y": 47, ",": 48, "6": 49,
+    "m": 54, "j": 55, "u": 56, ".": 57, "7": 58,
+    "l": 63, "k": 64, "i": 65, "/": 66, "8": 67, "\n": 69,
+}
+SHIFT_KEY = 8
+CODE_KEY = 35
+NUMLOCK_KEY = 44
+
+
+# ================= Traces ===================
+# A trace is the matrix state at every scan, built up from key actions at a fixed scan rate
+class Trace:
+    def __init__(self, scan_hz = 1000):
+        self.scan_hz = scan_hz
+        self.frames = []
+        self.held = 0
+        self.keystrokes = 0
+        # (scan, key, pressed) for every key put down or let go
+        self.edges = []
+
+    def wait(self, seconds):
+        self.frames.extend([self.held] * round(seconds * self.scan_hz))
+
+    def down(self, *keys):
+        for key in keys:
+            self.held |= 1 << key
+            self.keystrokes += 1
+            self.edges.append((len(self.frames), key, True))
+
+    def up(self, *keys):
+        for key in keys:
+            self.held &= ~(1 << key)
+            self.edges.append((len(self.frames), key, False))
+
+    # The key's contact bouncing for a number of scans after it was put down or let go: every other scan reads the
+    # other way, starting with the new level
+    def chatter(self, key, scans):
+        for n in range(scans):
+            self.frames.append(self.held ^ (1 << key) if n % 2 else self.held)
+
+    def tap(self, key, hold = 0.06, gap = 0.04):
+        self.down(key)
+        self.wait(hold)
+        self.up(key)
+        self.wait(gap)
+
+    def type(self, text, hold = 0.06, gap = 0.04):
+        for char in text:
+            self.tap(KEYS[char], hold, gap)
+
+
+def burst_trace():
+    trace = Trace()
+    for _ in range(5):
+        # ~120 wpm, then a short pause to think
+        trace.type("the quick brown fox jumps over the lazy dog\n", 0.05, 0.05)
+        trace.wait(0.5)
+    return trace
+
+
+def holds_trace():
+    trace = Trace()
+    trace.down(KEYS["a"])
+    trace.wait(2)
+    trace.up(KEYS["a"])
+    trace.wait(0.2)
+    # SHIFT held across several letters
+    trace.down(SHIFT_KEY)
+    trace.wait(0.1)
+    trace.type("hello")
+    trace.up(SHIFT_KEY)
+    trace.wait(0.2)
+    trace.down(KEYS["\n"])
+    trace.wait(3)
+    trace.up(KEYS["\n"])
+    trace.wait(0.2)
+    return trace
+
+
+def combos_trace():
+    trace = Trace()
+    for _ in range(10):
+        for modifier, key in ((SHIFT_KEY, "\b"), (SHIFT_KEY, "["), (CODE_KEY, "1"), (CODE_KEY, "9"), (CODE_KEY, "0"), (CODE_KEY, "/")):
+            trace.down(modifier)
+            trace.wait(0.05)
+            trace.tap(KEYS[key])
+            trace.up(modifier)
+            trace.wait(0.05)
+        # Modifier let go before the key, the path that used to leave keys stuck
+        trace.down(CODE_KEY)
+        trace.wait(0.05)
+        trace.down(KEYS["9"])
+        trace.wait(0.05)
+        trace.up(CODE_KEY)
+        trace.wait(0.05)
+        trace.up(KEYS["9"])
+        trace.wait(0.05)
+    return trace
+
+
+def numlock_trace():
+    trace = Trace()
+    for _ in range(10):
+        trace.tap(NUMLOCK_KEY)
+        trace.type("mjkluio")
+        trace.tap(NUMLOCK_KEY)
+        trace.type("mjkl")
+    return trace
+
+
+# Taps whose contacts chatter for 4 scans (4 ms at 1000 Hz, inside a 5 ms debounce window) when pressed and released
+def bounce_trace():
+    trace = Trace()
+    for char in "the quick brown fox jumps over the lazy dog":
+        key = KEYS[char]
+        trace.down(key)
+        trace.chatter(key, 4)
+        trace.wait(0.06)
+        trace.up(key)
+        trace.chatter(key, 4)
+        trace.wait(0.04)
+    return trace
+
+
+def idle_trace():
+    trace = Trace()
+    trace.wait(10)
+    return trace
+
+
+TRACES = {
+    "burst": burst_trace,
+    "holds": holds_trace,
+    "combos": combos_trace,
+    "numlock": numlock_trace,
+    "bounce": bounce_trace,
+    "idle": idle_trace,
+}
+
+
+# GPIO operations per scan over the trace, with or without probing first
+def gpio_ops(profile, frames, probe):
+    gpio = SimGPIO(profile.rows, profile.cols)
+    raw = 0
+    for frame in frames:
+        gpio.keys = frame
+        raw = gpio.scan_changed(raw) if probe else gpio.scan()
+    return gpio.ops / len(frames)
+
+
+def bench(path, trace):
+    keyboard = load_keyboard(path)
+    ui = keyboard.ui
+    gpio = SimGPIO(keyboard.profile.rows, keyboard.profile.cols)
+    scanner = MatrixScanner(gpio, keyboard.key_pressed, keyboard.key_released, ui.syn, trace.scan_hz)
+
+    frames = trace.frames
+    period = 1 / trace.scan_hz
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    collections = gc.get_stats()[0]["collections"]
+    wall = perf_counter()
+    cpu = process_time()
+
+    for n in range(len(frames)):
+        gpio.keys = frames[n]
+        scanner.poll(n * period)
+
+    cpu = process_time() - cpu
+    wall = perf_counter() - wall
+    collections = gc.get_stats()[0]["collections"] - collections
+    writes = len(ui.events) - ui.events.count(None)
+    # The recorded events are the only thing expected to grow
+    del ui.events[:]
+    gc.collect()
+    blocks = sys.getallocatedblocks() - blocks
+
+    return {
+        "scans_per_s": len(frames) / wall,
+        "full_ops_per_scan": gpio_ops(keyboard.profile, frames, False),
+        "probe_ops_per_scan": gpio_ops(keyboard.profile, frames, True),
+        "events_per_s": writes / wall,
+        "cpu_us_per_key": cpu * 1e6 / trace.keystrokes if trace.keystrokes else 0,
+        "blocks_per_scan": blocks / len(frames),
+        "gc_per_1k_scans": collections * 1000 / len(frames),
+    }
+
+
+# ================= Debounce check ===================
+DEBOUNCE_CHECKS = ("none", "defer:5", "eager:5", "counter:5")
+
+
+# Presses and releases the scanner sends for the trace with this PINE_DEBOUNCE setting, and the mean latency of each in
+# ms from the scan the key went down or up
+def debounce_run(trace, spec):
+    gpio = SimGPIO(list(range(8)), list(range(9)))
+    sent = []
+    n = 0
+    scanner = MatrixScanner(gpio, lambda key: sent.append((n, key, True)), lambda key: sent.append((n, key, False)),
+                            lambda: None, trace.scan_hz, debounce = spec, ghost = "off", probe = False)
+    period = 1 / trace.scan_hz
+    for n in range(len(trace.frames)):
+        gpio.keys = trace.frames[n]
+        scanner.poll(n * period)
+
+    result = {}
+    for pressed, name, ms in ((True, "presses", "press_ms"), (False, "releases", "release_ms")):
+        events = [event for event in sent if event[2] == pressed]
+        # Latency of each edge is to the first event of its kind for its key, chatter after that doesn't count
+        latency = []
+        for start, key, _ in (edge for edge in trace.edges if edge[2] == pressed):
+            scan = next((event[0] for event in events if event[1] == key and event[0] >= start), None)
+            if scan is not None:
+                latency.append((scan - start) * 1000 / trace.scan_hz)
+        result[name] = len(events)
+        result[ms] = sum(latency) / len(latency) if latency else 0
+    return result
+
+
+def debounce_check():
+    trace = bounce_trace()
+    taps = trace.keystrokes
+    results = {spec: debounce_run(trace, spec) for spec in DEBOUNCE_CHECKS}
+
+    print(f"{taps} taps, each bouncing for 4 scans at {trace.scan_hz:.0f} Hz")
+    print(f"{'debounce':10} {'presses':>8} {'releases':>9} {'press ms':>9} {'release ms':>11}")
+    for spec, result in results.items():
+        print(f"{spec:10} {result['presses']:8} {result['releases']:9} {result['press_ms']:9.2f} "
+              f"{result['release_ms']:11.2f}")
+
+    failures = []
+    if results["none"]["presses"] <= taps:
+        failures.append("the trace doesn't bounce without debouncing")
+    for spec in DEBOUNCE_CHECKS[1:]:
+        if (results[spec]["presses"], results[spec]["releases"]) != (taps, taps):
+            failures.append(f"{spec} sent {results[spec]['presses']} presses and {results[spec]['releases']} "
+                            f"releases for {taps} taps")
+    if not results["eager:5"]["press_ms"] < results["defer:5"]["press_ms"]:
+        failures.append("eager doesn't press before defer")
+    for failure in failures:
+        print(f"FAIL {failure}")
+    print(f"{len(failures)} failed" if failures else "all passed")
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark the keyboard profiles against scripted typing traces")
+    parser.add_argument("profiles", nargs = "*", default = PROFILES, help = "layout profiles (default: all five)")
+    parser.add_argument("-t", "--trace", action = "append", choices = list(TRACES), help = "traces to run (default: all)")
+    parser.add_argument("--json", help = "also write the results to this file")
+    parser.add_argument("--debounce", action = "store_true", help = "check the debounce algorithms against bouncing taps")
+    parser.add_argument("--log", action = "store_true", help = "keep the handlers' logging on (it is part of their cost)")
+    args = parser.parse_args()
+    if args.debounce:
+        sys.exit(debounce_check())
+
+    traces = {name: TRACES[name]() for name in (args.trace or TRACES)}
+    results = {}
+    if args.log:
+        logging.basicConfig(level = logging.INFO, format = '%(asctime)s - %(levelname)s - %(message)s')
+
+    print(f"{'profile':74} {'trace':8} {'scans/s':>9} {'events/s':>9} {'us/key':>8} {'blocks/scan':>11} {'gc/1k':>6} "
+          f"{'full ops':>8} {'probe ops':>9}")
+    for path in args.profiles:
+        for name, trace in traces.items():
+            try:
+                result = bench(path, trace)
+            except ImportError as err:
+                print(f"{path:74} unavailable: {err}")
+                break
+            results.setdefault(path, {})[name] = result
+            print(f"{path:74} {name:8} {result['scans_per_s']:9.0f} {result['events_per_s']:9.0f} "
+                  f"{result['cpu_us_per_key']:8.1f} {result['blocks_per_scan']:11.4f} {result['gc_per_1k_scans']:6.2f} "
+                  f"{result['full_ops_per_scan']:8.1f} {result['probe_ops_per_scan']:9.1f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent = 2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Command-line client for the kbd_daemon.py control socket.
+#
+#   python3 kbd_ctl.py status
+#   python3 kbd_ctl.py layout 102
+#   python3 kbd_ctl.py profile battery
+#   python3 kbd_ctl.py reload
+#   python3 kbd_ctl.py metrics
+#   python3 kbd_ctl.py --socket /tmp/kbd.sock pause
+#
+#   python3 kbd_ctl.py --selftest
+#
+# --selftest starts a daemon on the simulated matrix (PINE_GPIO=sim, no uinput device) with two layouts, drives keys
+# through the socket and checks every command, printing one line per check, then checks kbd_engine.py's reload in this
+# process.  Needs python-evdev unless the profiles are already compiled.
+#########################################################################################################################
+
+import os
+import sys
+import json
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from time import sleep, monotonic
+
+SOCKET = "/run/keyboard.sock"
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class Client:
+    def __init__(self, path, timeout = 5):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self.replies = self.sock.makefile("r")
+
+    def send(self, *words):
+        self.sock.sendall((" ".join(str(word) for word in words) + "\n").encode())
+        return json.loads(self.replies.readline())
+
+    def close(self):
+        self.replies.close()
+        self.sock.close()
+
+
+# ================= Self test ===================
+def connect(path, timeout = 10):
+    start = monotonic()
+    while True:
+        try:
+            return Client(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if monotonic() - start > timeout:
+                raise
+            sleep(0.05)
+
+
+# Poll until check(reply) holds for the command's reply, so the test doesn't depend on how fast the scan loop picks a
+# change up
+def wait_for(client, check, timeout = 2, command = "status"):
+    start = monotonic()
+    while True:
+        reply = client.send(command)
+        if check(reply) or monotonic() - start > timeout:
+            return reply
+        sleep(0.02)
+
+
+# kbd_engine.py's SIGHUP reload, in this process: CODE+9 goes down and the reload is asked for while the emitter thread
+# is still behind on a slow device, so frames queued before the reload are sent after it was asked for
+def engine_reload(path):
+    from kbd_engine import Keyboard, load_profile, reload_keyboards
+    from fake_uinput import FakeUInput, sent_keys
+    from matrix_gpio import SimGPIO
+    from matrix_scan import ScanLoop
+
+    class SlowUInput(FakeUInput):
+        def syn(self):
+            sleep(0.05)
+            super().syn()
+
+    keyboard = Keyboard(load_profile(path), SlowUInput())
+    old = keyboard.profile
+    gpio = SimGPIO(old.rows, old.cols)
+    loop = ScanLoop(gpio, keyboard.key_pressed, keyboard.key_released, keyboard.ui.syn)
+    threading.Thread(target = loop.run, name = "scan", daemon = True).start()
+    gpio.press(35)
+    sleep(0.03)
+    gpio.press(5)
+    sleep(0.03)
+    reload_keyboards(loop, [keyboard])
+    sleep(0.5)
+    gpio.release(5)
+    gpio.release(35)
+    sleep(0.5)
+    return keyboard.profile is not old, sent_keys(keyboard.ui.events)
+
+
+def selftest():
+    layouts = [os.path.join(HERE, "profiles", "keyboard_102_modded_capslock_numlock_with_CODE.json"),
+               os.path.join(HERE, "profiles", "keyboard_102.json")]
+    failures = 0
+
+    def check(name, ok, detail = ""):
+        nonlocal failures
+        print(f"{'ok  ' if ok else 'FAIL'} {name}{'' if ok else ': ' + str(detail)}")
+        failures += not ok
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "keyboard.sock")
+        env = dict(os.environ, PINE_GPIO = "sim", PINE_GOVERNOR = "fixed")
+        daemon = subprocess.Popen([sys.executable, os.path.join(HERE, "kbd_daemon.py"), "--socket", path,
+                                   "--fake-uinput"] + layouts, env = env)
+        try:
+            client = connect(path)
+
+            status = client.send("status")
+            check("status", status.get("layout") == "102_modded_capslock_numlock_with_CODE" and not status["paused"],
+                  status)
+
+            client.send("press", 8)
+            status = wait_for(client, lambda status: status["pressed"] == [8])
+            check("press shows in pressed", status["pressed"] == [8], status)
+            pressed = client.send("pressed")["pressed"]
+            check("pressed names the key", pressed and pressed[0]["key"] == "KEY_LEFTSHIFT", pressed)
+            client.send("release", 8)
+            status = wait_for(client, lambda status: not status["pressed"])
+            check("release clears pressed", not status["pressed"], status)
+
+            # CODE+9 held across the switch: what it sent is released in the old layout, the keys are pressed again in
+            # the new one, and nothing is left down on the device once they are let go
+            client.send("press", 35)
+            wait_for(client, lambda status: status["pressed"] == [35])
+            client.send("press", 5)
+            wait_for(client, lambda status: status["pressed"] == [5, 35])
+            sleep(0.1)
+            held = client.send("sent")["sent"]
+            reply = client.send("layout", "102")
+            status = wait_for(client, lambda status: status["layout"] == "102" and status["pressed"] == [5, 35])
+            client.send("release", 5)
+            client.send("release", 35)
+            wait_for(client, lambda status: not status["pressed"])
+            sent = wait_for(client, lambda reply: not reply["sent"], command = "sent")
+            check("layout switch", reply.get("ok") and status["pressed"] == [5, 35] and held
+                  and sent == {"sent": [], "repeated": []}, (status, held, sent))
+            check("unknown layout refused", "error" in client.send("layout", "nonesuch"))
+
+            client.send("layout", "102_modded_capslock_numlock_with_CODE")
+            wait_for(client, lambda status: status["layout"] == "102_modded_capslock_numlock_with_CODE")
+            client.send("press", 44)
+            wait_for(client, lambda status: status["pressed"] == [44])
+            client.send("release", 44)
+            status = wait_for(client, lambda status: status["num_lock"] == 1)
+            check("NumLock toggles", status["num_lock"] == 1, status)
+
+            client.send("layout", "102")
+            client.send("layout", "102_modded_capslock_numlock_with_CODE")
+            client.send("press", 1)
+            client.send("release", 1)
+            status = wait_for(client, lambda status: status["num_lock"] == 1 and not status["pressed"])
+            check("NumLock kept across layouts", status["num_lock"] == 1, status)
+
+            # CODE+9 held across a reload: released under the old profiles, pressed again under the new ones
+            client.send("press", 35)
+            wait_for(client, lambda status: status["pressed"] == [35])
+            client.send("press", 5)
+            wait_for(client, lambda status: status["pressed"] == [5, 35])
+            reply = client.send("reload")
+            sleep(0.2)
+            status = wait_for(client, lambda status: status["pressed"] == [5, 35])
+            client.send("release", 5)
+            client.send("release", 35)
+            wait_for(client, lambda status: not status["pressed"])
+            sent = wait_for(client, lambda reply: not reply["sent"], command = "sent")
+            check("reload", reply.get("ok") and status["pressed"] == [5, 35] and status["num_lock"] == 1
+                  and sent == {"sent": [], "repeated": []}, (status, sent))
+
+            client.send("pause")
+            client.send("press", 5)
+            sleep(0.2)
+            status = client.send("status")
+            check("pause ignores keys", status["paused"] and not status["pressed"], status)
+            client.send("release", 5)
+            client.send("resume")
+            client.send("press", 6)
+            status = wait_for(client, lambda status: status["pressed"] == [6])
+            check("resume scans again", not status["paused"] and status["pressed"] == [6], status)
+            client.send("release", 6)
+            wait_for(client, lambda status: not status["pressed"])
+
+            # Straight after each other, so the resume can come before the scan thread has taken up the pause
+            client.send("pause")
+            client.send("resume")
+            client.send("press", 7)
+            status = wait_for(client, lambda status: status["pressed"] == [7])
+            check("pause then resume at once", not status["paused"] and status["pressed"] == [7], status)
+            client.send("release", 7)
+            wait_for(client, lambda status: not status["pressed"])
+
+            client.send("profile", "battery")
+            status = client.send("status")
+            check("profile change", status["governor"] == "battery", status)
+            check("unknown profile refused", "error" in client.send("profile", "turbo"))
+
+            metrics = client.send("metrics").get("metrics", "")
+            check("metrics", "keyboard_scans_total" in metrics, metrics[:200])
+            check("unknown command refused", "error" in client.send("frobnicate"))
+            client.close()
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+    reloaded, sent = engine_reload(layouts[0])
+    check("engine reload", reloaded and sent == ([], []), sent)
+
+    print(f"{failures} failed" if failures else "all passed")
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Talk to the keyboard daemon")
+    parser.add_argument("command", nargs = "*", help = "command and arguments, e.g. status or layout 102")
+    parser.add_argument("--socket", default = SOCKET, help = f"control socket path (default {SOCKET})")
+    parser.add_argument("--selftest", action = "store_true", help = "check the daemon against the simulated matrix")
+    args = parser.parse_args()
+
+    if args.selftest:
+        sys.exit(selftest())
+    if not args.command:
+        parser.error("no command given")
+
+    client = Client(args.socket)
+    reply = client.send(*args.command)
+    client.close()
+    if "metrics" in reply:
+        print(reply["metrics"], end = "")
+    else:
+        print(json.dumps(reply, indent = 2))
+    if "error" in reply:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Keyboard daemon: the scan loop plus a control socket, in one process.
+#
+# Instead of starting kbd_engine.py with one profile from rc.local, start the daemon with the layout profiles it may
+# switch between; the first one is active at startup:
+#
+#   python3 /etc/kbd_daemon.py /etc/profiles/keyboard_102_modded_capslock_numlock_with_CODE.json \
+#       /etc/profiles/keyboard_102.json &
+#
+# Each profile gets its own kbd_engine.Keyboard, and they share one uinput device.  The scan loop (matrix_scan.py,
+# all the PINE_* settings apply) runs on its own thread; asyncio serves the control socket on the main thread.  A
+# request never touches the scan: queries only read state, and changes are handed to the scan thread to apply
+# between two scans (while the keyboard is idle, just before the key that wakes it is handled).
+#
+# The socket (--socket, default /run/keyboard.sock) takes one command per line and answers each with one line of JSON:
+#
+#       status          : layout, layouts, paused, governor and tier, num_lock, caps_lock, pressed keys
+#       pressed         : keys the handlers think are down, as scan value and key name
+#       metrics         : the Prometheus text from kbd_metrics.py
+#       layout <name>   : switch layout (file name without "keyboard_" and ".json"); held keys are released first
+#       reload          : load every layout's profile file again (also on SIGHUP), keeping the uinput device and
+#                         NumLock; held keys are released first and pressed again under the new profiles
+#       pause / resume  : stop and restart scanning, held keys are released on pause
+#       profile <name>  : change the polling governor (governor.py)
+#       press <n> / release <n> : close or open a key, only with PINE_GPIO=sim
+#       sent            : key codes the uinput device has down, and any pressed again while down (a lost release), from
+#                         what was written to it, only with --fake-uinput
+#
+# kbd_ctl.py sends commands from the shell, and "python3 kbd_ctl.py --selftest" checks all of this against the
+# simulated matrix with no hardware.
+#########################################################################################################################
+
+import os
+import sys
+import json
+import signal
+import asyncio
+import logging
+import argparse
+import threading
+from matrix_gpio import SimGPIO, open_gpio
+from matrix_scan import ScanLoop
+from governor import GOVERNORS
+from kbd_engine import Keyboard, load_profile, reload_profiles
+from kbd_trace import open_trace, LAYOUT
+from uinput_batch import open_batch_writer
+
+SOCKET = "/run/keyboard.sock"
+
+
+def layout_name(path):
+    name = os.path.basename(path)
+    if name.endswith(".json"):
+        name = name[:-5]
+    if name.startswith("keyboard_"):
+        name = name[len("keyboard_"):]
+    return name
+
+
+# A keyboard per profile.  The scan loop calls these handlers, which pass each call on to the current layout.
+class Layouts:
+    def __init__(self, profiles, ui):
+        self.ui = ui
+        self.keyboards = {layout_name(profile.path): Keyboard(profile, ui) for profile in profiles}
+        self.name = layout_name(profiles[0].path)
+        self.current = self.keyboards[self.name]
+        self.trace = open_trace()
+
+    def key_pressed(self, keycode):
+        self.current.key_pressed(keycode)
+
+    def key_released(self, keycode):
+        self.current.key_released(keycode)
+
+    # Called by the thread that runs the handlers, once the frame releasing every key has been sent
+    def switch(self, name):
+        keyboard = self.keyboards[name]
+        # NumLock is the keyboard's state, not the layout's
+        keyboard.num_lock = self.current.num_lock
+        self.current = keyboard
+        self.name = name
+        logging.info("Switched layout")
+        if self.trace:
+            self.trace.record(LAYOUT, list(self.keyboards.values()).index(keyboard))
+
+
+class Daemon:
+    def __init__(self, layouts, gpio):
+        self.gpio = gpio
+        self.layouts = layouts
+        self.loop = ScanLoop(gpio, self.layouts.key_pressed, self.layouts.key_released, self.layouts.ui.syn,
+                             collect_metrics = True)
+        # Each layout's settle_ns, and the layout whose settle_ns the GPIO has, kept on the scan thread
+        self.settle = {name: keyboard.profile.settle for name, keyboard in layouts.keyboards.items()}
+        self.settled = layouts.name
+        # What was last asked for; it takes effect between two scans
+        self.governor = self.loop.governor.name
+        # LED state read back from uinput (led_sync.py), None with a fake device
+        self.leds = None
+
+    # Keep the layout's num_lock with the NumLock LED, on the LED thread
+    def leds_changed(self, leds):
+        self.layouts.current.leds_changed(leds)
+
+    # ================= Commands ===================
+    def status(self):
+        current = self.layouts.current
+        return {
+            "layout": self.layouts.name,
+            "layouts": list(self.layouts.keyboards),
+            "paused": self.loop.paused,
+            "governor": self.governor,
+            "tier": self.loop.governor.tier,
+            "num_lock": current.num_lock,
+            "caps_lock": self.leds.caps_lock if self.leds else None,
+            "pressed": [key["keycode"] for key in self.pressed()],
+        }
+
+    def pressed(self):
+        profile = self.layouts.current.profile
+        keys = []
+        frame = self.loop.scanner.frame
+        for keycode in range(len(profile.base)):
+            if frame >> keycode & 1:
+                code = profile.base[keycode]
+                keys.append({"keycode": keycode, "key": "KEY_" + profile.names[code] if code in profile.names else code})
+        return keys
+
+    def switch_layout(self, name):
+        if name not in self.layouts.keyboards:
+            raise ValueError(f"Unknown layout {name}, have {', '.join(self.layouts.keyboards)}")
+
+        def switch(loop):
+            self.settled = name
+            loop.gpio.set_settle(self.settle[name])
+            # Switched once the release frame has been sent, so no key is pressed in one layout and released in another
+            loop.scanner.release_all(lambda: self.layouts.switch(name))
+        self.loop.call(switch)
+
+    # The profiles are compiled here, on the main thread, and every layout changes to its new one right after the frame
+    # that releases the held keys
+    def reload(self):
+        keyboards = self.layouts.keyboards
+        profiles = dict(zip(keyboards, reload_profiles(list(keyboards.values()))))
+
+        def reloaded():
+            for name, profile in profiles.items():
+                keyboards[name].use_profile(profile)
+
+        def swap(loop):
+            for name, profile in profiles.items():
+                self.settle[name] = profile.settle
+            loop.gpio.set_settle(self.settle[self.settled])
+            loop.scanner.release_all(reloaded)
+        self.loop.call(swap)
+
+    def reload_on_hangup(self):
+        try:
+            self.reload()
+        except ValueError as err:
+            logging.error(f"Not reloading: {err}")
+
+    def set_profile(self, name):
+        if name not in GOVERNORS:
+            raise ValueError(f"Unknown profile {name}, have {', '.join(GOVERNORS)}")
+        self.loop.set_governor(name)
+        self.governor = name
+
+    def sim_key(self, keycode, closed):
+        if not isinstance(self.gpio, SimGPIO):
+            raise ValueError("Keys can only be pressed from here on the simulated matrix (PINE_GPIO=sim)")
+        if closed:
+            self.gpio.press(keycode)
+        else:
+            self.gpio.release(keycode)
+
+    def sent(self):
+        events = getattr(self.layouts.ui, "events", None)
+        if events is None:
+            raise ValueError("What was sent can only be read back from the fake uinput device (--fake-uinput)")
+        from fake_uinput import sent_keys
+        down, repeated = sent_keys(events)
+        return {"sent": down, "repeated": repeated}
+
+    def command(self, words):
+        if not words:
+            raise ValueError("Empty command")
+        name, args = words[0], words[1:]
+        if name == "status":
+            return self.status()
+        if name == "pressed":
+            return {"pressed": self.pressed()}
+        if name == "metrics":
+            return {"metrics": self.loop.metrics.render()}
+        if name == "sent":
+            return self.sent()
+        if name == "layout" and len(args) == 1:
+            self.switch_layout(args[0])
+        elif name == "reload" and not args:
+            self.reload()
+        elif name == "pause":
+            self.loop.pause()
+        elif name == "resume":
+            self.loop.resume()
+        elif name == "profile" and len(args) == 1:
+            self.set_profile(args[0])
+        elif name in ("press", "release") and len(args) == 1:
+            self.sim_key(int(args[0]), name == "press")
+        else:
+            raise ValueError(f"Unknown command {' '.join(words)}")
+        return {"ok": True}
+
+    # ================= Socket ===================
+    async def handle(self, reader, writer):
+        try:
+            while line := await reader.readline():
+                try:
+                    reply = self.command(line.decode().split())
+                except ValueError as err:
+                    reply = {"error": str(err)}
+                writer.write((json.dumps(reply) + "\n").encode())
+                await writer.drain()
+        except ConnectionError as err:
+            logging.info(f"Control client went away: {err}")
+        finally:
+            writer.close()
+
+    async def serve(self, path):
+        loop = asyncio.get_running_loop()
+        stopped = loop.create_future()
+
+        # A plain daemon thread rather than the default executor, so the process can exit without joining the loop
+        def scan():
+            try:
+                self.loop.run()
+            except BaseException as err:
+                loop.call_soon_threadsafe(stopped.set_exception, err)
+        threading.Thread(target = scan, name = "scan", daemon = True).start()
+
+        if os.path.exists(path):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(self.handle, path)
+        loop.add_signal_handler(signal.SIGHUP, self.reload_on_hangup)
+        logging.info(f"Control socket on {path}")
+        try:
+            async with server:
+                await stopped
+        finally:
+            os.unlink(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Keyboard driver with a control socket")
+    parser.add_argument("layouts", nargs = "+", help = "layout profiles to load, the first is used at startup")
+    parser.add_argument("--socket", default = SOCKET, help = f"control socket path (default {SOCKET})")
+    parser.add_argument("--name", help = "uinput device name (default: the first profile's)")
+    parser.add_argument("--fake-uinput", action = "store_true", help = "don't open /dev/uinput (for testing)")
+    args = parser.parse_args()
+
+    profiles = [load_profile(path) for path in args.layouts]
+    for profile in profiles[1:]:
+        # Every layout is scanned on the pins the first one opened
+        if (profile.rows, profile.cols) != (profiles[0].rows, profiles[0].cols):
+            sys.exit(f"{profile.path} has other row or column pins than {profiles[0].path}")
+    logging.basicConfig(level = profiles[0].log_level, format = '%(asctime)s - %(levelname)s - %(message)s')
+    # python-evdev is only needed for a real device, so the selftest runs without it
+    if args.fake_uinput:
+        from fake_uinput import FakeUInput
+        ui = FakeUInput()
+    else:
+        from led_sync import open_uinput
+        ui = open_uinput(args.name or profiles[0].device)
+    layouts = Layouts(profiles, open_batch_writer(ui))
+    gpio = open_gpio(layouts.current.profile.rows, layouts.current.profile.cols)
+    gpio.set_settle(layouts.current.profile.settle)
+
+    daemon = Daemon(layouts, gpio)
+    if not args.fake_uinput:
+        from led_sync import watch_leds
+        daemon.leds = watch_leds(ui, daemon.leds_changed)
+    asyncio.run(daemon.serve(args.socket))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,522 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Keyboard driver for "PINE100" custom machine, based on TRS-80 Model 100 chasis, Tandy 102 Keyboard, and the PINE A64
+# single-board computer running Armbian OS which is a derivative of Linux.  This code is based on belsamber's original
+# 92-line GPIO script found here: https://fadsihave.wordpress.com/2021/01/02/gpio-based-keyboard-on-pine-a64/
+#
+# Information on my PINE100 hobby project can be found here: https://www.garyweber.net/pine-100/
+#
+# One driver for every keyboard: the layout comes from a profile in profiles/, a JSON file with
+#
+#       device      : uinput device name
+#       log_level   : logging level, e.g. INFO or CRITICAL
+#       rows, cols  : GPIO pins (BOARD numbering), rows are driven, columns are read; scan value = row * cols + col
+#       settle_ns   : optional, nanoseconds to wait after driving each row before reading the columns, written by
+#                     settle_cal.py for the wiring it measured
+#       layers      : base, and optional extra layers, each rows x cols evdev key names without the KEY_ prefix
+#       numlock     : optional, {"key": scan value that toggles NumLock, "layer": layer used while NumLock is on}
+#       modifiers   : keys that change what other keys send, each {"key": scan value, "layer": optional layer used
+#                     while the modifier is held}
+#       combos      : {"modifier", "key", "press", "release"}: while the modifier (or every modifier in a list of them)
+#                     is held, the key sends the press sequence instead of its layer key, and the release sequence when
+#                     it goes up.  Without "release", every key the press sequence pressed is released, last first
+#
+# Sequences are key names with "+" for press and "-" for release.  Combos are tried in file order, then the layer of
+# the first held modifier that has one, then NumLock, then base.
+#
+# The modifiers held and NumLock make up a state, and the profile is compiled into a table of what each key sends in
+# each state, so a keypress is one array lookup however many combos the profile has.  What a key sent when it went down
+# is kept until it comes up, and its release undoes exactly that, even if the modifiers or NumLock have changed since:
+# letting go of SHIFT or CODE before the key no longer leaves anything pressed.
+#
+# The compiled tables are cached in __pycache__ beside the profile, keyed by a hash of the file, so later starts don't
+# parse JSON or resolve key names again (and don't load evdev's key tables for it).
+#
+# Startup is ordered for the time to the first scan: only what the keyboard needs is imported up front (the real-time,
+# metrics socket and offline tools load their modules when used), and the uinput device is created on its own thread
+# while the GPIO pins are set up, so the system is already picking the keyboard up when scanning starts.
+#
+# Give more than one profile to scan extra matrices (a macro pad or number pad on spare pins, profiles/keypad_4x3.json)
+# from the same process and scan loop, each with its own pins and layout.  Profiles that name the same device send
+# through one shared uinput device; a different name gets a device of its own.
+#
+# After editing a profile, "kill -HUP <driver pid>" reloads every profile the driver was started with, without a
+# restart: the uinput devices stay (so the desktop doesn't drop and re-add the keyboard) and so does NumLock.  The
+# profiles are compiled off the scan thread and swapped in between two scans, with held keys released first.  Pins and
+# device names can't change this way.
+#
+#   python3 kbd_engine.py profiles/keyboard_102.json
+#   python3 kbd_engine.py profiles/keyboard_102.json profiles/keypad_4x3.json : two matrices, one scan loop
+#   python3 kbd_engine.py --compile profiles/keyboard_102.json         : compile and cache the profile, then exit
+#   python3 kbd_engine.py --startup-report profiles/keyboard_102.json  : start, scan once, print time and RSS per phase
+#########################################################################################################################
+
+import os
+import sys
+import zlib
+import marshal
+import logging
+import threading
+from array import array
+from types import SimpleNamespace
+from time import perf_counter, clock_gettime, CLOCK_BOOTTIME
+from kbd_trace import open_trace, PRESS, RELEASE, NUMLOCK
+
+EV_KEY = 1
+# emitted[] of a key that is up
+NO_ACTION = -1
+# Bump when the compiled form changes, so old cache files are not used
+FORMAT = 4
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+# ================= Profiles ===================
+class Profile:
+    def __init__(self, path, device, log_level, rows, cols, settle, base, numlock_key, modifier_bits, numlock_bit,
+                 table, actions, names):
+        self.path = path
+        self.device = device
+        self.log_level = log_level
+        self.rows = rows
+        self.cols = cols
+        self.keys = len(rows) * len(cols)
+        # Per-row settle time in ns, or None
+        self.settle = settle
+        # Base layer key code for every scan value (compiled as the bytes of the array)
+        self.base = array("H", base)
+        self.numlock_key = numlock_key
+        # State bit of the modifier on each scan value, 0 for the other keys, and the NumLock bit after them
+        self.modifier_bits = array("H", modifier_bits)
+        self.numlock_bit = numlock_bit
+        # Action for every (state, scan value), at state * keys + scan value
+        self.table = array("H", table)
+        # (press, release) sequences, each event key code << 1 | value
+        self.actions = actions
+        # Key code -> name, for logging
+        self.names = names
+        # Whether this came from the cache rather than being compiled now
+        self.cached = False
+
+
+def parse_sequence(events, codes, where):
+    sequence = []
+    for event in events:
+        if event[:1] not in ("+", "-"):
+            raise ValueError(f"{where}: {event!r} should start with + or -")
+        sequence.append(codes(event[1:], where) << 1 | (event[0] == "+"))
+    return tuple(sequence)
+
+
+# Release every key a press sequence pressed, last first
+def mirror(press):
+    return tuple(event & ~1 for event in reversed(press) if event & 1)
+
+
+# Key code of the first event in a sequence with the given value (1 pressed, 0 released), 0 if there is none; what a
+# trace records as the key sent, since a press sequence can start by releasing a modifier
+def first_code(sequence, value):
+    return next((event >> 1 for event in sequence if event & 1 == value), 0)
+
+
+# The compiled profile is only ints, strings, bytes and containers of them, so it can be saved with marshal
+def compile_profile(path, text):
+    import json
+    from evdev import ecodes
+
+    def codes(name, where):
+        code = getattr(ecodes, "KEY_" + name, None)
+        if code is None:
+            raise ValueError(f"{where}: no key called KEY_{name}")
+        names[code] = name
+        return code
+
+    names = {}
+    spec = json.loads(text)
+    rows, cols = spec["rows"], spec["cols"]
+    keys = len(rows) * len(cols)
+    settle = spec.get("settle_ns")
+    if settle is not None and len(settle) != len(rows):
+        raise ValueError(f"{path}: settle_ns has {len(settle)} entries, the matrix has {len(rows)} rows")
+
+    layers = {}
+    for name, layer in spec["layers"].items():
+        flat = [key for row in layer for key in row]
+        if len(flat) != keys:
+            raise ValueError(f"{path}: layer {name} has {len(flat)} keys, the matrix has {keys}")
+        layers[name] = [codes(key, f"{path}: layer {name}") for key in flat]
+
+    def layer(name, where):
+        if name not in layers:
+            raise ValueError(f"{path}: {where} uses layer {name}, which isn't defined")
+        return layers[name]
+
+    # Every held modifier is a bit of the state, NumLock is the bit above them
+    modifier_bits = [0] * keys
+    bits = {}
+    layered = []
+    for name, modifier in spec.get("modifiers", {}).items():
+        bits[name] = 1 << len(bits)
+        modifier_bits[modifier["key"]] = bits[name]
+        if "layer" in modifier:
+            layered.append((bits[name], layer(modifier["layer"], name)))
+    numlock_bit = 1 << len(bits)
+    numlock_key, numlock = -1, None
+    if "numlock" in spec:
+        numlock_key = spec["numlock"]["key"]
+        numlock = layer(spec["numlock"]["layer"], "numlock")
+
+    # Combos per scan value, as (modifier bits that must all be held, press, release), in file order
+    combos = [[] for _ in range(keys)]
+    for combo in spec.get("combos", []):
+        where = f"{path}: combo {combo['modifier']} {combo['key']}"
+        needed = 0
+        for name in [combo["modifier"]] if isinstance(combo["modifier"], str) else combo["modifier"]:
+            if name not in bits:
+                raise ValueError(f"{where}: no modifier called {name}")
+            needed |= bits[name]
+        press = parse_sequence(combo["press"], codes, where)
+        release = parse_sequence(combo["release"], codes, where) if "release" in combo else mirror(press)
+        combos[combo["key"]].append((needed, press, release))
+
+    # Resolve every key in every state now, so a keypress is one table lookup however many combos there are
+    actions = []
+    numbers = {}
+    table = []
+    for state in range(numlock_bit << 1):
+        for keycode in range(keys):
+            action = next(((press, release) for needed, press, release in combos[keycode] if state & needed == needed),
+                          None)
+            if action is None:
+                code = next((layer[keycode] for bit, layer in layered if state & bit), None)
+                if code is None:
+                    code = (numlock if state & numlock_bit and numlock else layers["base"])[keycode]
+                action = ((code << 1 | 1,), (code << 1,))
+            if action not in numbers:
+                numbers[action] = len(actions)
+                actions.append(action)
+            table.append(numbers[action])
+
+    return dict(path = path, device = spec.get("device", "Tandy 102 Keyboard"),
+                log_level = spec.get("log_level", "CRITICAL"), rows = rows, cols = cols, settle = settle,
+                base = array("H", layer("base", "base")).tobytes(), numlock_key = numlock_key,
+                modifier_bits = array("H", modifier_bits).tobytes(), numlock_bit = numlock_bit,
+                table = array("H", table).tobytes(), actions = tuple(actions), names = names)
+
+
+# The file's CRC and length name the cache file: it only has to tell one edit of the profile from the next, and zlib
+# loads much faster than hashlib's OpenSSL
+def cache_path(path, text):
+    directory, name = os.path.split(os.path.abspath(path))
+    digest = f"{FORMAT}{zlib.crc32(text):08x}{len(text):x}"
+    return os.path.join(directory, "__pycache__", f"{os.path.splitext(name)[0]}.{digest}.profile")
+
+
+# Load a profile, from the compiled cache if the file hasn't changed since it was last compiled
+def load_profile(path, compile = False):
+    with open(path, "rb") as f:
+        text = f.read()
+    cached = cache_path(path, text)
+    if not compile:
+        try:
+            with open(cached, "rb") as f:
+                fields = marshal.load(f)
+            fields["path"] = path
+            profile = Profile(**fields)
+            profile.cached = True
+            return profile
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+
+    fields = compile_profile(path, text)
+    try:
+        os.makedirs(os.path.dirname(cached), exist_ok = True)
+        # Written aside and renamed, so a driver starting at the same time never reads half a file
+        with open(cached + ".tmp", "wb") as f:
+            marshal.dump(fields, f)
+        os.replace(cached + ".tmp", cached)
+    except OSError as err:
+        logging.info(f"Not caching the compiled {path}: {err}")
+    return Profile(**fields)
+
+
+# ================= Key handling ===================
+class Keyboard:
+    def __init__(self, profile, ui = None):
+        self.profile = profile
+        self.ui = ui
+        self.num_lock = 0
+        # Bits of the modifiers held
+        self.held = 0
+        # Action each key sent when it was pressed, so its release undoes exactly that; NO_ACTION when it's up
+        self.emitted = array("i", [NO_ACTION] * profile.keys)
+        # Binary trace ring (kbd_trace.py, PINE_TRACE) instead of logging every key
+        self.trace = open_trace()
+
+    def send(self, sequence):
+        write = self.ui.write
+        for event in sequence:
+            write(EV_KEY, event >> 1, event & 1)
+
+    def state(self):
+        return self.held | self.profile.numlock_bit if self.num_lock else self.held
+
+    def key_pressed(self, keycode):
+        profile = self.profile
+        self.held |= profile.modifier_bits[keycode]
+        if keycode == profile.numlock_key:
+            self.num_lock = 0 if self.num_lock else 1
+            if self.trace:
+                self.trace.record(NUMLOCK, keycode, self.num_lock)
+
+        state = self.state()
+        action = self.emitted[keycode] = profile.table[state * profile.keys + keycode]
+        press = profile.actions[action][0]
+        if self.trace:
+            self.trace.record(PRESS, keycode, state, first_code(press, 1))
+        self.send(press)
+
+    def key_released(self, keycode):
+        profile = self.profile
+        action = self.emitted[keycode]
+        # Only a key that was down before this keyboard took over (a layout switch) has nothing recorded
+        if action == NO_ACTION:
+            action = profile.table[self.state() * profile.keys + keycode]
+        self.emitted[keycode] = NO_ACTION
+        self.held &= ~profile.modifier_bits[keycode]
+
+        release = profile.actions[action][1]
+        if self.trace:
+            self.trace.record(RELEASE, keycode, self.state(), first_code(release, 0))
+        self.send(release)
+
+    # Change to a reloaded profile.  Called by the thread that runs the handlers, right after the frame releasing every
+    # key (MatrixScanner.release_all()), so nothing pressed under the old profile is left to release under the new one.
+    # num_lock stays as it is.
+    def use_profile(self, profile):
+        self.profile = profile
+        self.held = 0
+        self.emitted = array("i", [NO_ACTION] * profile.keys)
+        logging.info(f"Reloaded {profile.path}")
+
+    # Follow the NumLock LED, so num_lock matches what the desktop has set (it's read back from our own uinput device)
+    def leds_changed(self, leds):
+        if leds.num_lock is not None:
+            self.num_lock = leds.num_lock
+
+
+# ================= Startup ===================
+def rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        return 0
+
+
+# Seconds since boot at which the kernel started this process, from /proc/self/stat
+def process_start():
+    try:
+        with open("/proc/self/stat") as f:
+            fields = f.read().rpartition(")")[2].split()
+        return int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+# Wall time and resident memory at the end of each startup phase, for --startup-report
+class Startup:
+    def __init__(self):
+        self.phases = []
+        self.started = process_start()
+        self.last = perf_counter()
+        # The interpreter starting up and importing this file, counted from when the process was started
+        if self.started is not None:
+            self.phases.append(("python + imports", clock_gettime(CLOCK_BOOTTIME) - self.started, rss()))
+
+    def phase(self, name):
+        now = perf_counter()
+        self.phases.append((name, now - self.last, rss()))
+        self.last = now
+
+    # A phase that ran on another thread, alongside the ones on the main thread
+    def alongside(self, name, seconds):
+        self.phases.append((f"  {name} (alongside)", seconds, None))
+
+    def report(self, out = sys.stderr):
+        total = 0
+        print(f"{'phase':28} {'ms':>8} {'total ms':>9} {'RSS MiB':>8}", file = out)
+        for name, seconds, resident in self.phases:
+            if resident is None:
+                print(f"{name:28} {seconds * 1000:8.1f}", file = out)
+                continue
+            total += seconds
+            print(f"{name:28} {seconds * 1000:8.1f} {total * 1000:9.1f} {resident / 2**20:8.1f}", file = out)
+        if self.started is not None:
+            print(f"Scanning {clock_gettime(CLOCK_BOOTTIME):.2f} s after boot", file = out)
+
+
+# Run fn(*args) on its own thread.  The returned function waits for it and gives its result or raises its error.
+def in_background(name, fn, *args):
+    result = {}
+
+    def target():
+        start = perf_counter()
+        try:
+            result["value"] = fn(*args)
+        except BaseException as err:
+            result["error"] = err
+        result["seconds"] = perf_counter() - start
+
+    thread = threading.Thread(target = target, name = name, daemon = True)
+    thread.start()
+
+    def wait():
+        thread.join()
+        if "error" in result:
+            raise result["error"]
+        return result["value"], result["seconds"]
+    return wait
+
+
+def open_uinput(device):
+    from led_sync import open_uinput
+    return open_uinput(device)
+
+
+# Every keyboard writing to ui follows its LEDs
+def follow_leds(ui, keyboards):
+    from led_sync import watch_leds
+
+    def changed(leds):
+        for keyboard in keyboards:
+            keyboard.leds_changed(leds)
+    watch_leds(ui, changed)
+
+
+# ================= Reloading ===================
+# Load the keyboards' profiles from their files again, compiling the ones that changed.  A profile with other pins or
+# another device name can't be swapped in, since the GPIO and uinput devices are kept: that raises ValueError.
+def reload_profiles(keyboards):
+    profiles = []
+    for keyboard in keyboards:
+        old = keyboard.profile
+        try:
+            profile = load_profile(old.path)
+        except (OSError, ValueError, KeyError) as err:
+            raise ValueError(f"Can't load {old.path}: {err!r}")
+        if (profile.rows, profile.cols, profile.device) != (old.rows, old.cols, old.device):
+            raise ValueError(f"{old.path} now has other pins or another device name, restart the driver for that")
+        profiles.append(profile)
+    return profiles
+
+
+# Reload every matrix's profile, compiled on this (not the scan) thread and swapped in between two scans.  Keys held at
+# the time are released under the old profile and the ones still down are pressed again under the new one.
+def reload_keyboards(loop, keyboards):
+    profiles = reload_profiles(keyboards)
+
+    def swap(loop):
+        for scanner, keyboard, profile in zip(loop.scanners, keyboards, profiles):
+            scanner.gpio.set_settle(profile.settle)
+            scanner.release_all(lambda keyboard = keyboard, profile = profile: keyboard.use_profile(profile))
+    loop.call(swap)
+
+
+# kill -HUP reloads the profiles, on a thread of its own
+def reload_on_hangup(loop, keyboards):
+    import signal
+
+    def reload():
+        try:
+            reload_keyboards(loop, keyboards)
+        except ValueError as err:
+            logging.error(f"Not reloading: {err}")
+
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target = reload, name = "reload").start())
+
+
+def parse_args(argv):
+    # The rc.local command line is just the profiles, and building an ArgumentParser takes longer than the rest of a
+    # cached start, so that case skips argparse
+    if argv and not any(arg.startswith("-") for arg in argv):
+        return SimpleNamespace(profiles = argv, compile = False, startup_report = False)
+
+    import argparse
+    parser = argparse.ArgumentParser(description = "PINE100 keyboard driver")
+    parser.add_argument("profiles", nargs = "+",
+                        help = "layout profile, e.g. profiles/keyboard_102.json, then one per extra matrix")
+    parser.add_argument("--compile", action = "store_true", help = "compile and cache the profile, then exit")
+    parser.add_argument("--startup-report", action = "store_true",
+                        help = "start up, scan once, print the time and memory each phase took and exit")
+    return parser.parse_args(argv)
+
+
+def main():
+    startup = Startup()
+    args = parse_args(sys.argv[1:])
+    startup.phase("arguments")
+
+    profiles = []
+    for path in args.profiles:
+        try:
+            profiles.append(load_profile(path, args.compile))
+        except (OSError, ValueError, KeyError) as err:
+            sys.exit(f"Can't load {path}: {err!r}")
+    if args.compile:
+        for path in args.profiles:
+            with open(path, "rb") as f:
+                text = f.read()
+            print(f"Compiled {path} to {cache_path(path, text)}")
+        return
+    logging.basicConfig(level = profiles[0].log_level, format = '%(asctime)s - %(levelname)s - %(message)s')
+    startup.phase("profile (cached)" if all(profile.cached for profile in profiles) else "profile (compiled)")
+
+    # The uinput devices are made (and evdev imported) on their own threads while the pins are set up on this one
+    uinputs = {device: in_background("uinput", open_uinput, device)
+               for device in dict.fromkeys(profile.device for profile in profiles)}
+
+    # Rows are driven outputs, columns are pulled-down inputs.  Set PINE_GPIO=sim to run against a simulated matrix.
+    from matrix_gpio import open_gpio
+    gpios = []
+    for profile in profiles:
+        gpios.append(open_gpio(profile.rows, profile.cols))
+        gpios[-1].set_settle(profile.settle)
+    startup.phase("gpio")
+    from matrix_scan import ScanLoop
+    startup.phase("scan loop imports")
+
+    seconds = 0
+    for device, uinput in uinputs.items():
+        uinputs[device], took = uinput()
+        seconds = max(seconds, took)
+    startup.phase("uinput, waiting for it")
+    startup.alongside("uinput", seconds)
+    # Each keyboard writes a frame's events to its device with one syscall (uinput_batch.py)
+    from uinput_batch import open_batch_writer
+    keyboards = [Keyboard(profile, open_batch_writer(uinputs[profile.device])) for profile in profiles]
+    for device, ui in uinputs.items():
+        follow_leds(ui, [keyboard for keyboard in keyboards if keyboard.profile.device == device])
+
+    # Matrices sharing a device have a writer each, and a frame from one is written whole between the other's
+    keyboard = keyboards[0]
+    loop = ScanLoop(gpios[0], keyboard.key_pressed, keyboard.key_released, keyboard.ui.syn)
+    for gpio, keyboard in zip(gpios[1:], keyboards[1:]):
+        loop.add_matrix(gpio, keyboard.key_pressed, keyboard.key_released, keyboard.ui.syn)
+    reload_on_hangup(loop, keyboards)
+    startup.phase("scan loop setup")
+
+    if args.startup_report:
+        loop.poll()
+        startup.phase("first scan")
+        startup.report()
+        for gpio in gpios:
+            gpio.cleanup()
+        return
+    logging.info(f"Keyboard ready, {sum(phase[1] for phase in startup.phases if phase[2] is not None) * 1000:.0f} ms "
+                 f"after the driver started")
+    loop.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Live metrics for the PINE100 keyboard scan loop, in Prometheus text format.
+#
+# Turned on by setting either (or both) of:
+#
+#       PINE_METRICS_FILE=/var/lib/node_exporter/keyboard.prom   : rewritten every PINE_METRICS_INTERVAL seconds (10)
+#       PINE_METRICS_SOCKET=/run/keyboard-metrics.sock           : a connection gets one snapshot, then is closed
+#                                                                  (e.g. "socat - UNIX-CONNECT:/run/keyboard-metrics.sock")
+#
+# What's collected:
+#
+#       keyboard_scans_total                 full matrix scans
+#       keyboard_scan_duration_seconds       histogram of time spent in one gpio.scan()
+#       keyboard_scan_interval_seconds       histogram of start-to-start time between scans (idle waits excluded)
+#       keyboard_scan_rate_hz                achieved scan rate, from the interval histogram
+#       keyboard_key_latency_seconds         histogram of time from the scan that first saw a raw change to ui.syn()
+#       keyboard_key_events_total            key presses/releases handed to the handlers
+#       keyboard_syn_reports_total           ui.syn() calls
+#       keyboard_idle_entries_total          times the loop went idle to wait for a column edge
+#       keyboard_idle                        1 while waiting for a keypress
+#       keyboard_scan_tier{tier}             1 for the polling tier the governor picked last (governor.py)
+#       keyboard_deadline_misses_total       scan deadlines missed, with PINE_RT (rt_sched.py)
+#       keyboard_wake_jitter_seconds         histogram of time from a scan deadline to running, with PINE_RT
+#       keyboard_queue_depth                 records waiting for the emitter thread (event_queue.py)
+#       keyboard_queue_max_depth             highest queue depth seen
+#       keyboard_queue_overflows_total       frames the queue had no room for (retried on the next scan)
+#       keyboard_gpio_errors_total           scans that raised an error
+#       keyboard_gpio_ops_total              GPIO library calls / syscalls / register accesses (see matrix_gpio.py)
+#       keyboard_ghost_frames_total          frames with a possible ghost-key rectangle
+#       keyboard_ghost_suppressed_total      key presses held back by the ghosting policy
+#
+# The scan loop only bumps integers and histogram slots in preallocated arrays; strings are only built when a
+# snapshot is rendered, on the exporter threads.
+#########################################################################################################################
+
+import os
+import logging
+import threading
+from array import array
+from bisect import bisect_left
+from time import sleep, perf_counter_ns
+
+# Histogram bucket upper bounds, in nanoseconds
+SCAN_BUCKETS = (10_000, 20_000, 50_000, 100_000, 200_000, 500_000, 1_000_000, 2_000_000, 5_000_000, 10_000_000,
+                20_000_000, 50_000_000, 100_000_000, 200_000_000, 500_000_000, 1_000_000_000)
+
+
+class Histogram:
+    def __init__(self, name, help, bounds = SCAN_BUCKETS):
+        self.name = name
+        self.help = help
+        self.bounds = bounds
+        # One slot per bound plus +Inf
+        self.counts = array("Q", [0] * (len(bounds) + 1))
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, ns):
+        self.counts[bisect_left(self.bounds, ns)] += 1
+        self.sum += ns
+        self.count += 1
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} histogram")
+        total = 0
+        for n in range(len(self.bounds)):
+            total += self.counts[n]
+            lines.append(f'{self.name}_bucket{{le="{self.bounds[n] / 1e9:g}"}} {total}')
+        total += self.counts[-1]
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {total}')
+        lines.append(f"{self.name}_sum {self.sum / 1e9:.9f}")
+        lines.append(f"{self.name}_count {self.count}")
+
+
+class Metrics:
+    def __init__(self, gpio = None, ghosts = None):
+        self.gpio = gpio
+        self.ghosts = ghosts
+        # Set by the scan loop
+        self.governor = None
+        self.deadlines = None
+        self.queue = None
+
+        self.scans = 0
+        self.key_events = 0
+        self.syn_reports = 0
+        self.idle_entries = 0
+        self.idle = 0
+        self.gpio_errors = 0
+
+        self.scan_duration = Histogram("keyboard_scan_duration_seconds", "Time spent reading the whole matrix")
+        self.scan_interval = Histogram("keyboard_scan_interval_seconds", "Time between the starts of consecutive scans")
+        self.key_latency = Histogram("keyboard_key_latency_seconds", "Time from first raw detection to ui.syn()")
+
+        self.last_start = 0
+        self.last_raw = 0
+        # perf_counter_ns() of the scan that first saw the raw change not yet reported, 0 if none
+        self.first_seen = 0
+
+    # ================= Called from the scan loop ===================
+    def scanned(self, start, end, raw):
+        self.scans += 1
+        self.scan_duration.observe(end - start)
+        if self.last_start:
+            self.scan_interval.observe(start - self.last_start)
+        self.last_start = start
+        if raw != self.last_raw:
+            if not self.first_seen:
+                self.first_seen = start
+            self.last_raw = raw
+
+    def synced(self, events):
+        self.key_events += events
+        self.syn_reports += 1
+        if self.first_seen:
+            self.key_latency.observe(perf_counter_ns() - self.first_seen)
+            self.first_seen = 0
+
+    # A raw change that was filtered out (bounce, ghosting) never reaches ui.syn(), so stop timing it
+    def settled(self):
+        self.first_seen = 0
+
+    def idle_start(self):
+        self.idle_entries += 1
+        self.idle = 1
+
+    def idle_end(self):
+        self.idle = 0
+        # The wait isn't a scan interval
+        self.last_start = 0
+
+    # ================= Rendering ===================
+    def render(self):
+        lines = []
+
+        def metric(name, kind, help, value):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.append(f"{name} {value}")
+
+        metric("keyboard_scans_total", "counter", "Full matrix scans", self.scans)
+        self.scan_duration.render(lines)
+        self.scan_interval.render(lines)
+        rate = self.scan_interval.count * 1e9 / self.scan_interval.sum if self.scan_interval.sum else 0
+        metric("keyboard_scan_rate_hz", "gauge", "Achieved scan rate while not idle", f"{rate:.3f}")
+        self.key_latency.render(lines)
+        metric("keyboard_key_events_total", "counter", "Key presses and releases dispatched", self.key_events)
+        metric("keyboard_syn_reports_total", "counter", "ui.syn() calls", self.syn_reports)
+        metric("keyboard_idle_entries_total", "counter", "Times the loop went idle", self.idle_entries)
+        metric("keyboard_idle", "gauge", "1 while waiting for a keypress", self.idle)
+        if self.governor is not None:
+            lines.append("# HELP keyboard_scan_tier Polling tier picked by the governor")
+            lines.append("# TYPE keyboard_scan_tier gauge")
+            for tier in ("fast", "slow", "slower", "idle"):
+                lines.append(f'keyboard_scan_tier{{tier="{tier}"}} {int(self.governor.tier == tier)}')
+        if self.deadlines is not None:
+            metric("keyboard_deadline_misses_total", "counter", "Scan deadlines missed", self.deadlines.misses)
+            self.deadlines.jitter.render(lines)
+        if self.queue is not None:
+            metric("keyboard_queue_depth", "gauge", "Records waiting for the emitter", self.queue.depth())
+            metric("keyboard_queue_max_depth", "gauge", "Highest emitter queue depth", self.queue.max_depth)
+            metric("keyboard_queue_overflows_total", "counter", "Frames the emitter queue had no room for",
+                   self.queue.overflows)
+        metric("keyboard_gpio_errors_total", "counter", "Scans that raised an error", self.gpio_errors)
+        if self.gpio is not None:
+            metric("keyboard_gpio_ops_total", "counter", "GPIO operations", self.gpio.ops)
+        if self.ghosts is not None:
+            metric("keyboard_ghost_frames_total", "counter", "Frames with a possible ghost key", self.ghosts.ghost_frames)
+            metric("keyboard_ghost_suppressed_total", "counter", "Presses held back by the ghosting policy", self.ghosts.suppressed)
+        return "\n".join(lines) + "\n"
+
+
+# ================= Exporters ===================
+def write_file(metrics, path, interval):
+    while True:
+        sleep(interval)
+        # Write then rename, so a scraper never reads a half-written file
+        with open(path + ".tmp", "w") as f:
+            f.write(metrics.render())
+        os.replace(path + ".tmp", path)
+
+
+def listen_socket(path):
+    # Only imported when the socket exporter is on, it isn't needed to start the keyboard
+    import socket
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(4)
+    return server
+
+
+def serve_socket(metrics, server):
+    while True:
+        conn, _ = server.accept()
+        with conn:
+            try:
+                conn.sendall(metrics.render().encode())
+            except OSError as err:
+                logging.info(f"Metrics client went away: {err}")
+
+
+# Start collecting if PINE_METRICS_FILE or PINE_METRICS_SOCKET is set, or always is, otherwise return None
+def open_metrics(gpio = None, ghosts = None, always = False):
+    path = os.environ.get("PINE_METRICS_FILE")
+    sock = os.environ.get("PINE_METRICS_SOCKET")
+    if not path and not sock:
+        return Metrics(gpio, ghosts) if always else None
+
+    metrics = Metrics(gpio, ghosts)
+    if path:
+        interval = float(os.environ.get("PINE_METRICS_INTERVAL", 10))
+        logging.info(f"Writing metrics to {path} every {interval} s")
+        threading.Thread(target = write_file, args = (metrics, path, interval), daemon = True).start()
+    if sock:
+        logging.info(f"Serving metrics on {sock}")
+        threading.Thread(target = serve_socket, args = (metrics, listen_socket(sock)), daemon = True).start()
+    return metrics
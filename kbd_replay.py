@@ -0,0 +1,86 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Replay a raw frame recording (frame_record.py, PINE_RECORD) through a layout profile, with no hardware.
+#
+# The profile's handlers (kbd_engine.py) run behind the real MatrixScanner with the debounce and ghost settings stored in the recording,
+# and every scan is fed the recorded timestamp, so the run is deterministic.  The uinput events the driver would have
+# sent are written out, or checked against a golden file from an earlier run, one event per line ("type code value",
+# and "SYN" for ui.syn()).
+#
+#   python3 kbd_replay.py profiles/keyboard_102.json bug.frames                      : print the event stream
+#   python3 kbd_replay.py profiles/keyboard_102.json bug.frames --write-golden bug.events
+#   python3 kbd_replay.py profiles/keyboard_102.json bug.frames --golden bug.events  : exit status 1 on the first difference
+#   python3 kbd_replay.py profiles/keyboard_102.json bug.frames --realtime           : sleep between scans as recorded
+#
+# Needs python-evdev to compile a profile that isn't in the cache yet.
+#########################################################################################################################
+
+import sys
+import logging
+import argparse
+from time import sleep, perf_counter_ns
+from matrix_gpio import SimGPIO
+from matrix_scan import MatrixScanner
+from frame_record import read_frames
+from fake_uinput import load_keyboard
+
+
+def replay(path, recording, realtime = False):
+    header, frames = read_frames(recording)
+    keyboard = load_keyboard(path)
+    ui = keyboard.ui
+    gpio = SimGPIO(keyboard.profile.rows, keyboard.profile.cols)
+    if (len(gpio.rows), len(gpio.cols)) != (header["rows"], header["cols"]):
+        raise ValueError(f"{recording} is a {header['rows']}x{header['cols']} matrix, {path} is "
+                         f"{len(gpio.rows)}x{len(gpio.cols)}")
+    scanner = MatrixScanner(gpio, keyboard.key_pressed, keyboard.key_released, ui.syn, header["scan_hz"],
+                            header["debounce"], header["ghost"])
+
+    start = perf_counter_ns()
+    first = frames[0][0] if frames else 0
+    for ns, frame in frames:
+        if realtime:
+            delay = (ns - first) - (perf_counter_ns() - start)
+            if delay > 0:
+                sleep(delay / 1e9)
+        gpio.keys = frame
+        scanner.poll(ns / 1e9)
+    return ["SYN" if event is None else "%d %d %d" % event for event in ui.events]
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Replay a raw frame recording through a layout profile")
+    parser.add_argument("profile", help = "layout profile, e.g. profiles/keyboard_102.json")
+    parser.add_argument("recording", help = "file captured with PINE_RECORD")
+    parser.add_argument("--realtime", action = "store_true", help = "replay at recorded speed instead of flat out")
+    parser.add_argument("--golden", help = "compare the events against this file")
+    parser.add_argument("--write-golden", help = "save the events to this file")
+    parser.add_argument("--log", action = "store_true", help = "log every key the handlers see")
+    args = parser.parse_args()
+
+    if args.log:
+        logging.basicConfig(level = logging.INFO, format = '%(asctime)s - %(levelname)s - %(message)s')
+    events = replay(args.profile, args.recording, args.realtime)
+
+    if args.write_golden:
+        with open(args.write_golden, "w") as f:
+            f.write("\n".join(events) + "\n")
+    if not args.golden:
+        if not args.write_golden:
+            print("\n".join(events))
+        return
+
+    with open(args.golden) as f:
+        golden = f.read().splitlines()
+    for n in range(max(len(events), len(golden))):
+        got = events[n] if n < len(events) else "(end)"
+        want = golden[n] if n < len(golden) else "(end)"
+        if got != want:
+            print(f"Event {n}: expected {want}, got {got}")
+            sys.exit(1)
+    print(f"{len(events)} events match {args.golden}")
+
+
+if __name__ == "__main__":
+    main()
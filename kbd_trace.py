@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Binary trace ring for the PINE100 keyboard driver, in place of per-key logging.
+#
+# The handlers used to log every key with an f-string, which is formatted even when the logging level throws it away,
+# so the scripts had their logging commented out.  With PINE_TRACE set, the driver instead keeps the last PINE_TRACE
+# events (1 for the default of 16384) as fixed-size records in two preallocated arrays:
+#
+#       stamp   : CLOCK_MONOTONIC nanoseconds
+#       record  : kind | keycode << 8 | state << 16 | code << 32
+#
+# kind is one of KINDS below, keycode the scan value, state the modifier/NumLock state bits the key was looked up in
+# (the NumLock setting for a numlock record) and code the first key code the key pressed, or released for a release
+# record.  Recording a key is a scan of a short sequence and two array stores; without PINE_TRACE the driver holds
+# None and each call site is a single "if trace" test.
+#
+# kill -USR1 <driver pid> writes the ring, oldest first, to PINE_TRACE_FILE (default /var/tmp/keyboard.trace).  Decode
+# it with:
+#
+#   python3 kbd_trace.py /var/tmp/keyboard.trace                                  : kinds and numbers
+#   python3 kbd_trace.py /var/tmp/keyboard.trace --profile /etc/keyboard.json     : with key names
+#########################################################################################################################
+
+import os
+import sys
+import struct
+import signal
+import logging
+import threading
+from array import array
+from itertools import count
+from time import monotonic_ns
+
+PRESS = 1
+RELEASE = 2
+NUMLOCK = 3
+IDLE = 4
+WAKE = 5
+LAYOUT = 6
+KINDS = {PRESS: "press", RELEASE: "release", NUMLOCK: "numlock", IDLE: "idle", WAKE: "wake", LAYOUT: "layout"}
+
+MAGIC = b"PKTR"
+VERSION = 1
+# magic, version, records in the file
+HEADER = struct.Struct("<4sHxxI")
+RECORD = struct.Struct("<QQ")
+TRACE_FILE = "/var/tmp/keyboard.trace"
+
+
+class TraceRing:
+    def __init__(self, capacity = 16384):
+        # A power of two, so the slot is a mask rather than a modulo
+        self.capacity = 1 << max(capacity - 1, 1).bit_length()
+        self.mask = self.capacity - 1
+        self.stamps = array("Q", bytes(8 * self.capacity))
+        self.records = array("Q", bytes(8 * self.capacity))
+        # next() on a count is atomic, so the scan thread and the emitter thread never get the same slot
+        self.slots = count()
+
+    def record(self, kind, keycode = 0, state = 0, code = 0):
+        n = next(self.slots) & self.mask
+        self.stamps[n] = monotonic_ns()
+        self.records[n] = kind | keycode << 8 | state << 16 | code << 32
+
+    # (stamp, record) for every slot used, oldest first
+    def snapshot(self):
+        return sorted((stamp, record) for stamp, record in zip(self.stamps, self.records) if stamp)
+
+    def dump(self, path):
+        entries = self.snapshot()
+        with open(path + ".tmp", "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(entries)))
+            for entry in entries:
+                f.write(RECORD.pack(*entry))
+        os.replace(path + ".tmp", path)
+        return len(entries)
+
+
+def decode(record):
+    return record & 0xFF, record >> 8 & 0xFF, record >> 16 & 0xFFFF, record >> 32 & 0xFFFF
+
+
+def read_trace(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, entries = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} isn't a keyboard trace")
+    return [RECORD.unpack_from(data, HEADER.size + n * RECORD.size) for n in range(entries)]
+
+
+trace = None
+
+
+# The process's trace ring if PINE_TRACE is set, otherwise None.  Every caller gets the same ring, and the first call
+# (which has to be on the main thread for the signal) sets up the SIGUSR1 dump.
+def open_trace():
+    global trace
+    setting = os.environ.get("PINE_TRACE", "")
+    if setting in ("", "0") or trace is not None:
+        return trace
+    trace = TraceRing(16384 if setting == "1" else int(setting))
+    path = os.environ.get("PINE_TRACE_FILE", TRACE_FILE)
+
+    def dump(signum, frame):
+        try:
+            logging.warning(f"Wrote {trace.dump(path)} trace records to {path}")
+        except OSError as err:
+            logging.error(f"Can't write the trace to {path}: {err}")
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, dump)
+        logging.info(f"Tracing the last {trace.capacity} events, kill -USR1 {os.getpid()} writes them to {path}")
+    else:
+        logging.warning("Tracing, but not on the main thread, so SIGUSR1 can't dump the trace")
+    return trace
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description = "Decode a keyboard trace written on SIGUSR1")
+    parser.add_argument("trace", nargs = "?", default = TRACE_FILE, help = f"trace file (default {TRACE_FILE})")
+    parser.add_argument("--profile", help = "layout profile, to name the keys")
+    args = parser.parse_args()
+
+    profile = None
+    if args.profile:
+        from kbd_engine import load_profile
+        profile = load_profile(args.profile)
+
+    entries = read_trace(args.trace)
+    first = entries[0][0] if entries else 0
+    for stamp, record in entries:
+        kind, keycode, state, code = decode(record)
+        line = f"{(stamp - first) / 1e6:12.3f} ms  {KINDS.get(kind, kind):8}"
+        if kind in (PRESS, RELEASE):
+            line += f" key {keycode:3}  state {state:#04x}  sends {code}"
+            if profile:
+                line += f" {profile.names.get(code, '')}  (matrix {profile.names.get(profile.base[keycode], '')})"
+        elif kind == NUMLOCK:
+            line += f" {'on' if state else 'off'}"
+        elif kind == LAYOUT:
+            line += f" layout {keycode}"
+        print(line)
+    if not entries:
+        print("No trace records", file = sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
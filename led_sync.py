@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# NumLock / CapsLock LED state for the PINE100 keyboard, read back from the driver's own uinput device.
+#
+# The uinput device is created with the NumLock and CapsLock LEDs (open_uinput()), so when the desktop or the console
+# changes them the kernel hands an EV_LED event back on the same file descriptor the driver writes keys to.
+# watch_leds() starts a thread that sleeps in poll() on that fd and, for each change, updates num_lock/caps_lock and
+# calls back into the driver.  That keeps the driver's num_lock in step with what the system thinks, with no polling
+# and no second process.  test_numlock.py prints the LED changes from outside the driver.
+#########################################################################################################################
+
+import os
+import select
+import struct
+import logging
+import threading
+from evdev import UInput, ecodes as e
+
+# struct input_event: struct timeval, type, code, value
+INPUT_EVENT = struct.Struct("llHHi")
+
+
+# The uinput device for the keyboard: every key, as evdev gives by default, plus the two lock LEDs
+def open_uinput(name):
+    return UInput({e.EV_KEY: e.keys.keys(), e.EV_LED: [e.LED_NUML, e.LED_CAPSL]}, name = name, vendor = 0x01,
+                  product = 0x01)
+
+
+class LedSync:
+    def __init__(self, fd, on_change = None):
+        self.fd = fd
+        self.on_change = on_change
+        # None until the system first sets the LED
+        self.num_lock = None
+        self.caps_lock = None
+
+    def update(self, data):
+        changed = False
+        for offset in range(0, len(data) - INPUT_EVENT.size + 1, INPUT_EVENT.size):
+            _, _, etype, code, value = INPUT_EVENT.unpack_from(data, offset)
+            if etype != e.EV_LED:
+                continue
+            if code == e.LED_NUML:
+                changed |= self.num_lock != value
+                self.num_lock = value
+            elif code == e.LED_CAPSL:
+                changed |= self.caps_lock != value
+                self.caps_lock = value
+        if changed:
+            logging.info(f"LEDs: num_lock = {self.num_lock}, caps_lock = {self.caps_lock}")
+            if self.on_change:
+                self.on_change(self)
+
+    def run(self):
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        while True:
+            poller.poll()
+            try:
+                data = os.read(self.fd, INPUT_EVENT.size * 16)
+            except BlockingIOError:
+                continue
+            except OSError as err:
+                logging.error(f"Reading LED events failed, no longer following the LEDs: {err}")
+                return
+            self.update(data)
+
+
+# Follow the LEDs of a device made with open_uinput().  on_change(leds) is called on the watcher thread.
+def watch_leds(ui, on_change = None):
+    leds = LedSync(ui.fd, on_change)
+    threading.Thread(target = leds.run, name = "leds", daemon = True).start()
+    return leds
+
@@ -0,0 +1,392 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# GPIO access for the PINE100 keyboard matrix.  The driver only ever does a handful of things with the pins: drive
+# a row high or low, read the column pins, and when the keyboard is idle, wait for any column to go high.  Those are
+# collected here so the same scan loop can run on RPi.GPIO or against a simulated matrix with no hardware attached.
+#
+# Pick the backend with the PINE_GPIO environment variable:
+#
+#       PINE_GPIO=rpi   : RPi.GPIO in BOARD numbering (default)
+#       PINE_GPIO=sim   : in-memory simulated matrix, keys are closed with press()/release()
+#       PINE_GPIO=a64   : memory-mapped Allwinner A64 PIO registers (a64_pio.py), whole-port column reads
+#       PINE_GPIO=cdev  : GPIO character device (gpio_cdev.py), bulk row/column line requests, 16 syscalls per scan
+#       PINE_GPIO=auto  : the first of AUTO_ORDER that can be opened on this board
+#
+# read_cols() returns the column pins as a bitmask:  bit j is set when cols[j] reads high.  scan() drives each row in
+# turn and returns the whole matrix as one integer frame:  bit (i * len(cols) + j) is set when the key at row i, column j
+# is closed, the same number the driver uses as a keycode.
+#
+# A long ribbon cable needs time after a row is driven before the columns read true.  set_settle() takes a busy-wait
+# per row in nanoseconds (the profile's settle_ns, measured by settle_cal.py), which scan() spends between driving each
+# row and reading the columns; without it rows are read straight away.
+#
+# Most scans find nothing pressed, so scan_changed() starts with a probe: every row driven high at once and the columns
+# read once.  With no key closed no column can go high, so a probe that reads nothing is the whole (empty) frame.  While
+# keys are held, only the rows that had keys in the last frame are scanned one by one, and the other rows are probed
+# together; they are only scanned row by row if that probe sees a column go high.  A row driven together with others
+# can only read more than it would on its own, never less, so a probe never misses a key a full scan would have found.
+#
+# Several matrices can be scanned by one loop (kbd_engine.py with more than one profile).  wait_for_any() idles on all of
+# them at once: edge-waiting backends each block on their own thread and whichever wakes first sets the shared event
+# and interrupt()s the others, so an extra matrix adds no wakeups while idle.
+#
+# Every backend counts its hardware operations (library calls, syscalls or register accesses) in ops.  gpio_bench.py
+# uses that and scan() to compare the backends available on a board.
+#########################################################################################################################
+
+import os
+import logging
+import importlib
+import threading
+from time import sleep, perf_counter_ns
+
+
+# Yield the position of every set bit in a frame, lowest first
+def frame_keys(bits):
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+
+# ================= Base class ===================
+# Backends only need drive_row(), read_cols() and cleanup().  The idle wait here is the fallback for backends that
+# can't arm edge detection: drive every row high and poll the columns slowly until one of them closes.
+class MatrixGPIO:
+    name = None
+    ops = 0
+    # True when wait_for_keypress() sleeps until a column edge rather than polling
+    edge_wait = False
+    # Nanoseconds to wait after driving each row, None to read straight away
+    settle = None
+
+    def __init__(self, rows, cols):
+        self.rows = list(rows)
+        self.cols = list(cols)
+
+    def drive_row(self, i, level):
+        raise NotImplementedError
+
+    def read_cols(self):
+        raise NotImplementedError
+
+    def drive_all_rows(self, level):
+        for i in range(len(self.rows)):
+            self.drive_row(i, level)
+
+    # Drive the rows whose bits are set in the mask.  Backends that can set several pins with one operation override it.
+    def drive_rows(self, rows, level):
+        for i in frame_keys(rows):
+            self.drive_row(i, level)
+
+    def set_settle(self, settle):
+        if settle is not None and len(settle) != len(self.rows):
+            raise ValueError(f"{len(settle)} settle times for {len(self.rows)} rows")
+        self.settle = list(settle) if settle and any(settle) else None
+
+    def scan(self):
+        if self.settle:
+            return self.scan_settled()
+        width = len(self.cols)
+        frame = 0
+        for i in range(len(self.rows)):
+            self.drive_row(i, 1)
+            frame |= self.read_cols() << (i * width)
+            self.drive_row(i, 0)
+        return frame
+
+    # Busy-wait rather than sleep: the delays are a few microseconds, far below what a sleep can wake up for
+    def scan_settled(self):
+        width = len(self.cols)
+        settle = self.settle
+        frame = 0
+        for i in range(len(self.rows)):
+            self.drive_row(i, 1)
+            deadline = perf_counter_ns() + settle[i]
+            while perf_counter_ns() < deadline:
+                pass
+            frame |= self.read_cols() << (i * width)
+            self.drive_row(i, 0)
+        return frame
+
+    # scan() of just the rows in the mask, the others read as nothing pressed
+    def scan_rows(self, rows):
+        width = len(self.cols)
+        settle = self.settle
+        frame = 0
+        for i in frame_keys(rows):
+            self.drive_row(i, 1)
+            if settle:
+                deadline = perf_counter_ns() + settle[i]
+                while perf_counter_ns() < deadline:
+                    pass
+            frame |= self.read_cols() << (i * width)
+            self.drive_row(i, 0)
+        return frame
+
+    # Drive the rows in the mask high together and read the columns once: bit j is set if column j has a closed key on
+    # any of them
+    def probe(self, rows):
+        self.drive_rows(rows, 1)
+        if self.settle:
+            deadline = perf_counter_ns() + max(self.settle[i] for i in frame_keys(rows))
+            while perf_counter_ns() < deadline:
+                pass
+        bits = self.read_cols()
+        self.drive_rows(rows, 0)
+        return bits
+
+    # The frame scan() would return, given the last one, probing first so rows with nothing on them aren't scanned
+    def scan_changed(self, last):
+        all_rows = (1 << len(self.rows)) - 1
+        if not last:
+            return self.scan() if self.probe(all_rows) else 0
+
+        width = len(self.cols)
+        mask = (1 << width) - 1
+        held = 0
+        for i in range(len(self.rows)):
+            if last >> (i * width) & mask:
+                held |= 1 << i
+        quiet = all_rows & ~held
+        # A probe of the quiet rows only pays while it covers more than one row
+        if quiet & (quiet - 1) == 0:
+            return self.scan()
+
+        frame = self.scan_rows(held)
+        if self.probe(quiet):
+            frame |= self.scan_rows(quiet)
+        return frame
+
+    # Block until any key closes.  Returns False if the timeout (in seconds) ran out first.  woke is a threading.Event
+    # shared with waits on other matrices: the wait also ends when it's set, and sets it on a keypress.
+    def wait_for_keypress(self, timeout = None, woke = None, poll_time = 1/5):
+        self.drive_all_rows(1)
+        try:
+            waited = 0
+            while not self.read_cols():
+                if woke and woke.is_set():
+                    return False
+                if timeout is not None and waited >= timeout:
+                    return False
+                sleep(poll_time)
+                waited += poll_time
+            if woke:
+                woke.set()
+            return True
+        finally:
+            self.drive_all_rows(0)
+
+    # End a wait_for_keypress() running on another thread, after its woke event has been set
+    def interrupt(self):
+        pass
+
+    def cleanup(self):
+        pass
+
+
+# ================= RPi.GPIO ===================
+class RPiGPIO(MatrixGPIO):
+    name = "rpi"
+    edge_wait = True
+
+    def __init__(self, rows, cols):
+        super().__init__(rows, cols)
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+
+        GPIO.setmode(GPIO.BOARD)
+
+        # RPi.GPIO only finds a bad pin number when it gets to it, so the pins set up before it are let go again (and
+        # only those, not another matrix's)
+        done = []
+        try:
+            for row in self.rows:
+                logging.debug(f"Setting pin {row} as an output")
+                GPIO.setup(row, GPIO.OUT)
+                done.append(row)
+
+            for col in self.cols:
+                logging.debug(f"Setting pin {col} as an input")
+                GPIO.setup(col, GPIO.IN, pull_up_down = GPIO.PUD_DOWN)
+                done.append(col)
+        except (ValueError, RuntimeError):
+            if done:
+                GPIO.cleanup(done)
+            raise
+
+    def drive_row(self, i, level):
+        self.GPIO.output(self.rows[i], self.GPIO.HIGH if level else self.GPIO.LOW)
+        self.ops += 1
+
+    def read_cols(self):
+        bits = 0
+        for j in range(len(self.cols)):
+            if self.GPIO.input(self.cols[j]) == self.GPIO.HIGH:
+                bits |= 1 << j
+        self.ops += len(self.cols)
+        return bits
+
+    # With every row driven high, any closed key pulls its column high, so a rising edge on any column means a key
+    # went down.  The callbacks run on RPi.GPIO's own thread; this one sleeps on the Event with no timer wakeups.
+    def wait_for_keypress(self, timeout = None, woke = None):
+        GPIO = self.GPIO
+        woke = woke or threading.Event()
+        armed = []
+
+        self.drive_all_rows(1)
+        try:
+            try:
+                for col in self.cols:
+                    GPIO.add_event_detect(col, GPIO.RISING, callback = lambda channel: woke.set())
+                    armed.append(col)
+            except RuntimeError:
+                # Edge detection isn't available for this pin/library, fall back to slow polling
+                logging.info("Edge detection unavailable, polling while idle")
+                return super().wait_for_keypress(timeout, woke)
+
+            # A key that closed before the edges were armed would never fire a callback
+            if self.read_cols():
+                woke.set()
+                return True
+            return woke.wait(timeout)
+        finally:
+            for col in armed:
+                GPIO.remove_event_detect(col)
+            self.drive_all_rows(0)
+
+    def cleanup(self):
+        self.GPIO.cleanup()
+
+
+# ================= Simulated matrix ===================
+# Keys are addressed by the same scan value the drivers use (row * len(cols) + column).  A closed key connects its row to
+# its column, so a column reads high if any driven row has a closed key on it.  wakeups counts how many times the idle
+# wait woke up, so a test can check it slept straight through until the keypress.
+class SimGPIO(MatrixGPIO):
+    name = "sim"
+    edge_wait = True
+
+    def __init__(self, rows, cols):
+        super().__init__(rows, cols)
+        self.row_levels = [0] * len(self.rows)
+        self.keys = 0
+        self.wakeups = 0
+        self.changed = threading.Condition()
+
+    def press(self, keycode):
+        with self.changed:
+            self.keys |= 1 << keycode
+            self.changed.notify_all()
+
+    def release(self, keycode):
+        with self.changed:
+            self.keys &= ~(1 << keycode)
+            self.changed.notify_all()
+
+    def drive_row(self, i, level):
+        with self.changed:
+            self.row_levels[i] = level
+            self.changed.notify_all()
+        self.ops += 1
+
+    # Counted like RPi.GPIO, one operation per column pin
+    def read_cols(self):
+        width = len(self.cols)
+        mask = (1 << width) - 1
+        bits = 0
+        for i in range(len(self.rows)):
+            if self.row_levels[i]:
+                bits |= (self.keys >> (i * width)) & mask
+        self.ops += width
+        return bits
+
+    def wait_for_keypress(self, timeout = None, woke = None):
+        self.drive_all_rows(1)
+        try:
+            with self.changed:
+                while not self.read_cols():
+                    if woke and woke.is_set():
+                        return False
+                    if not self.changed.wait(timeout):
+                        return False
+                    self.wakeups += 1
+                if woke:
+                    woke.set()
+                return True
+        finally:
+            self.drive_all_rows(0)
+
+    def interrupt(self):
+        with self.changed:
+            self.changed.notify_all()
+
+
+# Block until a key closes on any of the matrices.  With one, that's just its wait_for_keypress().  If every backend can
+# wait on an edge, each extra matrix waits on its own thread; otherwise they're all polled together on this one.
+def wait_for_any(gpios, timeout = None, poll_time = 1/5):
+    if len(gpios) == 1:
+        return gpios[0].wait_for_keypress(timeout)
+
+    if not all(gpio.edge_wait for gpio in gpios):
+        for gpio in gpios:
+            gpio.drive_all_rows(1)
+        try:
+            waited = 0
+            while not any(gpio.read_cols() for gpio in gpios):
+                if timeout is not None and waited >= timeout:
+                    return False
+                sleep(poll_time)
+                waited += poll_time
+            return True
+        finally:
+            for gpio in gpios:
+                gpio.drive_all_rows(0)
+
+    woke = threading.Event()
+
+    def wait(gpio):
+        if gpio.wait_for_keypress(timeout, woke):
+            for other in gpios:
+                if other is not gpio:
+                    other.interrupt()
+
+    threads = [threading.Thread(target = wait, args = (gpio,), name = "idle", daemon = True) for gpio in gpios[1:]]
+    for thread in threads:
+        thread.start()
+    wait(gpios[0])
+    for thread in threads:
+        thread.join()
+    return woke.is_set()
+
+
+# Backend name : (module, class).  Modules are only imported when their backend is picked.
+BACKENDS = {
+    "rpi": ("matrix_gpio", "RPiGPIO"),
+    "sim": ("matrix_gpio", "SimGPIO"),
+    "a64": ("a64_pio", "A64PIO"),
+    "cdev": ("gpio_cdev", "CdevGPIO"),
+}
+
+# Hardware backends tried by PINE_GPIO=auto, fastest first
+AUTO_ORDER = ("a64", "cdev", "rpi")
+
+
+# Set up the row and column pins on the backend named by PINE_GPIO (or the backend argument)
+def open_gpio(rows, cols, backend = None):
+    if backend is None:
+        backend = os.environ.get("PINE_GPIO", "rpi")
+
+    if backend == "auto":
+        for name in AUTO_ORDER:
+            try:
+                return open_gpio(rows, cols, name)
+            # ValueError: a pin the backend can't drive.  It has let go of any pins it set up first.
+            except (ImportError, OSError, RuntimeError, ValueError) as err:
+                logging.info(f"GPIO backend {name} unavailable: {err}")
+        raise RuntimeError("No GPIO backend could be opened")
+
+    logging.info(f"Using GPIO backend {backend}")
+    module, cls = BACKENDS[backend]
+    return getattr(importlib.import_module(module), cls)(rows, cols)
@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Scan loop for the PINE100 keyboard driver.
+#
+# Each poll reads the whole matrix into one integer frame (bit i * len(cols) + j is the key at row i, column j, the same
+# number the layouts use as a keycode) and XORs it against the previous frame.  Only the bits that changed are handed to
+# the driver's key_pressed()/key_released() handlers, in ascending keycode order just like the old row/column loop, so a
+# poll where nothing changed costs a single integer compare.
+#
+# Raw frames go through the debouncer (PINE_DEBOUNCE, debounce.py) and then the ghost-key filter (PINE_GHOST,
+# ghosting.py) before they are compared.
+#
+# Scans probe first (matrix_gpio.scan_changed()), so a poll with nothing pressed reads the columns once instead of once
+# per row, and while keys are held only their rows are scanned in full.  PINE_PROBE=0 scans every row every time.
+#
+# PINE_SCAN_HZ sets the polling rate (default 60).  Raising it is only worth doing with debouncing turned on.  Between
+# bursts of typing the polling governor (PINE_GOVERNOR, governor.py) decides when to slow down or go idle.  PINE_RT=1
+# schedules scans on absolute deadlines instead of sleeping between them (rt_sched.py).
+#
+# A scan that raises an error is skipped rather than killing the driver.  Set PINE_METRICS_FILE and/or
+# PINE_METRICS_SOCKET to export scan and latency metrics (kbd_metrics.py).
+#
+# MatrixScanner.poll() is one scan and dispatch with no sleeping, so kbd_bench.py can drive it from a trace.
+#
+# Set PINE_RECORD to capture every raw frame to a ring file (frame_record.py) that kbd_replay.py can play back.
+# PINE_TRACE keeps the last keys handled and idle periods in a binary ring (kbd_trace.py), written out on SIGUSR1.
+#
+# run() hands changed keys to an emitter thread through a bounded queue (PINE_QUEUE, event_queue.py), so a slow write
+# to /dev/uinput doesn't hold up the next scan.  MatrixScanner on its own calls the handlers inline.
+#
+# ScanLoop can scan more than one matrix (add_matrix()), each with its own scanner, filters, handlers and emitter
+# thread, under the one governor: every poll scans them all, and the loop only goes idle when they are all quiet, to
+# wait on all of them at once (matrix_gpio.wait_for_any()).  Metrics and PINE_RECORD cover the first matrix.
+#
+# ScanLoop is run() as an object, for kbd_daemon.py: other threads hand it commands with call(), which it runs between
+# two scans, and pause() / resume() stop and restart scanning with any held keys released.
+#########################################################################################################################
+
+import os
+import logging
+import threading
+from collections import deque
+from time import sleep, monotonic, monotonic_ns, perf_counter_ns
+from matrix_gpio import frame_keys, wait_for_any
+from debounce import open_debouncer
+from ghosting import open_ghost_filter
+from kbd_metrics import open_metrics
+from frame_record import open_recorder
+from governor import open_governor
+from rt_sched import open_deadline_timer
+from event_queue import open_event_queue
+from kbd_trace import open_trace, IDLE, WAKE
+
+# Normal polling rate
+SCAN_HZ = float(os.environ.get("PINE_SCAN_HZ", 60))
+# Probe before scanning row by row
+PROBE = os.environ.get("PINE_PROBE", "1") not in ("", "0")
+
+
+class MatrixScanner:
+    # debounce, ghost and probe override PINE_DEBOUNCE, PINE_GHOST and PINE_PROBE.  collect_metrics keeps metrics even
+    # with no exporter.  export = False leaves metrics and frame recording to another matrix's scanner.
+    def __init__(self, gpio, key_pressed, key_released, syn, scan_hz = SCAN_HZ, debounce = None, ghost = None,
+                 collect_metrics = False, probe = None, export = True):
+        self.gpio = gpio
+        self.key_pressed = key_pressed
+        self.key_released = key_released
+        self.syn = syn
+
+        self.debouncer = open_debouncer(len(gpio.rows) * len(gpio.cols), 1 / scan_hz, debounce)
+        self.ghosts = open_ghost_filter(len(gpio.rows), len(gpio.cols), ghost)
+        self.metrics = open_metrics(gpio, self.ghosts, collect_metrics) if export else None
+        self.recorder = open_recorder(len(gpio.rows), len(gpio.cols), scan_hz, debounce, ghost) if export else None
+
+        # Last frame handed to the handlers
+        self.frame = 0
+        # Last frame read from the matrix, which the probe scan starts from
+        self.raw = 0
+        self.probe = PROBE if probe is None else probe
+        # Emitter queue, set by run(); None to call the handlers from poll()
+        self.queue = None
+
+    # Nothing held, nothing settling and no contact closed, so it's safe to go idle.  A closed contact the filters are
+    # holding back (a ghost rectangle) would end the idle wait at once, over and over.
+    def quiet(self):
+        return not self.frame and not self.raw and not (self.debouncer and self.debouncer.pending)
+
+    # Scan once and dispatch any changes.  now is the monotonic time for the debouncer, taken from the clock if not
+    # given.  Returns True if anything was sent.
+    def poll(self, now = None):
+        metrics = self.metrics
+
+        start = perf_counter_ns()
+        try:
+            raw = self.gpio.scan_changed(self.raw) if self.probe else self.gpio.scan()
+        except (OSError, RuntimeError) as err:
+            logging.error(f"Matrix scan failed: {err}")
+            if metrics:
+                metrics.gpio_errors += 1
+            return False
+        self.raw = raw
+        if metrics:
+            metrics.scanned(start, perf_counter_ns(), raw)
+        if self.recorder:
+            ns = monotonic_ns() if now is None else round(now * 1e9)
+            self.recorder.record(ns, raw)
+            if now is None:
+                now = ns / 1e9
+
+        new_frame = raw
+        if self.debouncer:
+            new_frame = self.debouncer.update(new_frame, monotonic() if now is None else now)
+        if self.ghosts:
+            new_frame = self.ghosts.filter(new_frame)
+
+        changed = new_frame ^ self.frame
+        if not changed:
+            if metrics and new_frame == raw:
+                metrics.settled()
+            return False
+
+        if self.queue:
+            # A frame that doesn't fit stays pending in the difference and is offered again on the next scan
+            if not self.queue.push(changed, new_frame):
+                return False
+            self.frame = new_frame
+            return True
+
+        self.frame = new_frame
+        for keycode in frame_keys(changed):
+            if new_frame >> keycode & 1:
+                self.key_pressed(keycode)
+            else:
+                self.key_released(keycode)
+        self.syn()
+        if metrics:
+            metrics.synced(bin(changed).count("1"))
+        return True
+
+    # Send a release for every key the handlers think is down, as one frame ending in syn(), even if nothing is.  Keys
+    # that are still physically held get pressed again on the next poll.  then() is called right after that syn(), on
+    # the thread that runs the handlers, before any later frame.
+    def release_all(self, then = None):
+        changed = self.frame
+        self.frame = 0
+        if self.queue:
+            while not self.queue.push(changed, 0):
+                sleep(0.001)
+            if then:
+                self.queue.call(then)
+            return
+        for keycode in frame_keys(changed):
+            self.key_released(keycode)
+        self.syn()
+        if then:
+            then()
+
+
+class ScanLoop:
+    def __init__(self, gpio, key_pressed, key_released, syn, collect_metrics = False):
+        self.gpio = gpio
+        self.scanner = MatrixScanner(gpio, key_pressed, key_released, syn, collect_metrics = collect_metrics)
+        self.metrics = self.scanner.metrics
+        self.scanners = [self.scanner]
+        self.gpios = [gpio]
+        self.governor = open_governor(SCAN_HZ, gpio.edge_wait)
+        self.timer = open_deadline_timer()
+        self.trace = open_trace()
+        self.scanner.queue = open_event_queue(len(gpio.rows) * len(gpio.cols), key_pressed, key_released, syn,
+                                              self.metrics)
+        if self.metrics:
+            self.metrics.governor = self.governor
+            self.metrics.deadlines = self.timer
+            self.metrics.queue = self.scanner.queue
+
+        # Functions to run on the scan thread between two scans, each called with this loop
+        self.commands = deque()
+        self.running = threading.Event()
+        self.running.set()
+        self.paused = False
+        # Held while paused is checked and running changed, so a resume can't land in between
+        self.pausing = threading.Lock()
+
+    # Scan another matrix in the same loop, before run()
+    def add_matrix(self, gpio, key_pressed, key_released, syn):
+        scanner = MatrixScanner(gpio, key_pressed, key_released, syn, export = False)
+        scanner.queue = open_event_queue(len(gpio.rows) * len(gpio.cols), key_pressed, key_released, syn)
+        self.scanners.append(scanner)
+        self.gpios.append(gpio)
+        if not gpio.edge_wait:
+            self.governor = open_governor(SCAN_HZ, False)
+            if self.metrics:
+                self.metrics.governor = self.governor
+        return scanner
+
+    # Every matrix can go idle
+    def quiet(self):
+        for scanner in self.scanners:
+            if not scanner.quiet():
+                return False
+        return True
+
+    def poll(self):
+        sent = False
+        for scanner in self.scanners:
+            if scanner.poll():
+                sent = True
+        return sent
+
+    def call(self, command):
+        self.commands.append(command)
+
+    def pause(self):
+        self.paused = True
+
+        # A resume() that came in before the scan thread got to this has already cancelled it
+        def stop(loop):
+            with loop.pausing:
+                if loop.paused:
+                    loop.running.clear()
+        self.call(stop)
+
+    def resume(self):
+        with self.pausing:
+            self.paused = False
+            self.running.set()
+
+    def set_governor(self, name):
+        governor = open_governor(SCAN_HZ, all(gpio.edge_wait for gpio in self.gpios), name)
+
+        def swap(loop):
+            governor.activity(monotonic())
+            loop.governor = governor
+            if loop.metrics:
+                loop.metrics.governor = governor
+        self.call(swap)
+
+    def run(self):
+        scanners = self.scanners
+        metrics = self.metrics
+        timer = self.timer
+        commands = self.commands
+        # Count the silence from startup
+        self.governor.activity(monotonic())
+
+        while True:
+            while commands:
+                commands.popleft()(self)
+            if not self.running.is_set():
+                logging.info("Scanning paused")
+                for scanner in scanners:
+                    scanner.release_all()
+                self.running.wait()
+                logging.info("Scanning resumed")
+                self.governor.activity(monotonic())
+                if timer:
+                    timer.reset()
+                continue
+
+            governor = self.governor
+            period = governor.period(monotonic(), self.quiet())
+            if period is None:
+                # Drive every row high and block on a column edge, then go straight back to full-rate scanning
+                logging.info("Idle, waiting for a keypress")
+                if self.trace:
+                    self.trace.record(IDLE)
+                if timer:
+                    timer.report()
+                if metrics:
+                    metrics.idle_start()
+                wait_for_any(self.gpios)
+                if self.trace:
+                    self.trace.record(WAKE)
+                if metrics:
+                    metrics.idle_end()
+                if timer:
+                    timer.reset()
+                # Anything asked for while idle happens before the key that woke us is handled
+                while commands:
+                    commands.popleft()(self)
+                if not self.running.is_set():
+                    continue
+            elif timer:
+                timer.wait(period)
+            else:
+                sleep(period)
+
+            if self.poll():
+                governor.activity(monotonic())
+
+
+def run(gpio, key_pressed, key_released, syn):
+    ScanLoop(gpio, key_pressed, key_released, syn).run()
@@ -0,0 +1,199 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Real-time scheduling for the PINE100 keyboard scan loop (opt-in).
+#
+# The normal loop sleeps for a period after each scan, so the real period is the sleep plus the scan plus whatever the
+# scheduler adds, and the rate drifts.  With PINE_RT=1 each scan is instead scheduled on an absolute CLOCK_MONOTONIC
+# deadline (clock_nanosleep with TIMER_ABSTIME), one period after the previous deadline, so scan time and wakeup
+# latency don't accumulate.  A deadline that has already passed is counted as missed and skipped, rather than
+# scanning several times back to back to catch up.
+#
+# Also optional, and all need root (or CAP_SYS_NICE / CAP_IPC_LOCK):
+#
+#       PINE_RT_PRIORITY=50 : run under SCHED_FIFO at this priority
+#       PINE_RT_CPU=3       : pin the process to this core (the A64 has 0-3)
+#       PINE_RT_MLOCK=1     : lock all current and future memory, so a scan never waits on a page fault
+#
+# Missed deadlines and wakeup jitter (time from the deadline to actually running) go into the metrics
+# (keyboard_deadline_misses_total, keyboard_wake_jitter_seconds) and are logged when the driver goes idle.
+#
+#   python3 rt_sched.py --hz 1000 --seconds 30 --priority 50 --cpu 3 --mlock
+#
+# runs the scan loop against the simulated matrix and prints misses and jitter percentiles; run it next to a load
+# (e.g. "stress -c 4") to check the board holds the rate.
+#########################################################################################################################
+
+import os
+import logging
+from array import array
+from time import sleep, monotonic_ns
+from kbd_metrics import Histogram
+
+CLOCK_MONOTONIC = 1
+TIMER_ABSTIME = 1
+EINTR = 4
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+# Wakeup jitter histogram bounds, in nanoseconds
+JITTER_BUCKETS = (1_000, 2_000, 5_000, 10_000, 20_000, 50_000, 100_000, 200_000, 500_000, 1_000_000, 2_000_000,
+                  5_000_000, 10_000_000)
+# Raw jitter samples kept for percentiles
+JITTER_SAMPLES = 65536
+
+
+# ctypes is loaded on first use, not at import: find_library() pulls in subprocess and shutil, and the driver only
+# needs any of it with PINE_RT
+ctypes = None
+libc = None
+timespec = None
+
+
+def load_libc():
+    global ctypes, libc, timespec
+    if ctypes is None:
+        import ctypes
+        import ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+            libc.clock_nanosleep
+        except (OSError, AttributeError):
+            libc = None
+    return libc
+
+
+class DeadlineTimer:
+    def __init__(self):
+        self.deadline = None
+        self.misses = 0
+        self.wakeups = 0
+        self.jitter = Histogram("keyboard_wake_jitter_seconds", "Time from a scan deadline to the loop running",
+                                JITTER_BUCKETS)
+        self.samples = array("q", [0] * JITTER_SAMPLES)
+        load_libc()
+        # Preallocated so sleeping doesn't build a new struct every scan
+        self.request = timespec()
+
+    # Sleep until one period after the last deadline.  Returns the number of deadlines missed since the last call.
+    def wait(self, period):
+        period_ns = int(period * 1e9)
+        now = monotonic_ns()
+        if self.deadline is None:
+            self.deadline = now + period_ns
+        else:
+            self.deadline += period_ns
+
+        missed = 0
+        if self.deadline <= now:
+            missed = (now - self.deadline) // period_ns + 1
+            self.misses += missed
+            self.deadline += missed * period_ns
+
+        self.sleep_until(self.deadline)
+        late = monotonic_ns() - self.deadline
+        self.jitter.observe(late)
+        self.samples[self.wakeups % JITTER_SAMPLES] = late
+        self.wakeups += 1
+        return missed
+
+    def sleep_until(self, deadline):
+        if libc is None:
+            sleep(max(0, deadline - monotonic_ns()) / 1e9)
+            return
+        request = self.request
+        request.tv_sec, request.tv_nsec = divmod(deadline, 1_000_000_000)
+        # clock_nanosleep returns the error number rather than setting errno, and an absolute sleep can just be
+        # restarted after a signal
+        while libc.clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, ctypes.byref(request), None) == EINTR:
+            pass
+
+    # Start a fresh schedule, after the loop has been idle
+    def reset(self):
+        self.deadline = None
+
+    def percentiles(self, fractions = (0.5, 0.99, 0.999, 1.0)):
+        ordered = sorted(self.samples[:min(self.wakeups, JITTER_SAMPLES)])
+        if not ordered:
+            return {fraction: 0 for fraction in fractions}
+        return {fraction: ordered[int(fraction * (len(ordered) - 1))] for fraction in fractions}
+
+    def report(self):
+        jitter = self.percentiles()
+        logging.info(f"Scan deadlines: {self.misses} missed in {self.wakeups}, jitter p50 {jitter[0.5] / 1000:.0f} us "
+                     f"p99 {jitter[0.99] / 1000:.0f} us p99.9 {jitter[0.999] / 1000:.0f} us max {jitter[1.0] / 1000:.0f} us")
+
+
+# SCHED_FIFO, CPU pinning and memory locking.  Each one that fails is logged and skipped.
+def setup_realtime(priority = None, cpu = None, lock = False):
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+            logging.info(f"Pinned to CPU {cpu}")
+        except OSError as err:
+            logging.warning(f"Can't pin to CPU {cpu}: {err}")
+
+    if lock:
+        if load_libc() is not None and libc.mlockall(MCL_CURRENT | MCL_FUTURE) == 0:
+            logging.info("Memory locked")
+        else:
+            logging.warning(f"Can't lock memory: {os.strerror(ctypes.get_errno())}")
+
+    if priority is not None:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+            logging.info(f"Running SCHED_FIFO at priority {priority}")
+        except OSError as err:
+            logging.warning(f"Can't switch to SCHED_FIFO: {err}")
+
+
+# Set up real-time scheduling and return a DeadlineTimer if PINE_RT is set, otherwise return None
+def open_deadline_timer():
+    if os.environ.get("PINE_RT", "0") in ("", "0"):
+        return None
+    priority = os.environ.get("PINE_RT_PRIORITY")
+    cpu = os.environ.get("PINE_RT_CPU")
+    setup_realtime(int(priority) if priority else None, int(cpu) if cpu else None,
+                   os.environ.get("PINE_RT_MLOCK", "0") not in ("", "0"))
+    if load_libc() is None:
+        logging.warning("No clock_nanosleep, falling back to sleep() until each deadline")
+    return DeadlineTimer()
+
+
+def main():
+    import argparse
+    from matrix_gpio import SimGPIO
+    from matrix_scan import MatrixScanner
+
+    parser = argparse.ArgumentParser(description = "Check the deadline scan loop holds its rate on this board")
+    parser.add_argument("--hz", type = float, default = 1000)
+    parser.add_argument("--seconds", type = float, default = 10)
+    parser.add_argument("--priority", type = int, help = "SCHED_FIFO priority")
+    parser.add_argument("--cpu", type = int, help = "core to pin to")
+    parser.add_argument("--mlock", action = "store_true", help = "lock memory")
+    args = parser.parse_args()
+
+    setup_realtime(args.priority, args.cpu, args.mlock)
+    gpio = SimGPIO(range(8), range(9))
+    scanner = MatrixScanner(gpio, lambda keycode: None, lambda keycode: None, lambda: None, args.hz)
+    timer = DeadlineTimer()
+
+    scans = int(args.hz * args.seconds)
+    start = monotonic_ns()
+    for _ in range(scans):
+        timer.wait(1 / args.hz)
+        scanner.poll()
+    elapsed = (monotonic_ns() - start) / 1e9
+
+    jitter = timer.percentiles()
+    print(f"{scans} scans in {elapsed:.3f} s, {scans / elapsed:.1f} Hz, {timer.misses} deadlines missed")
+    print(f"jitter p50 {jitter[0.5] / 1000:.1f} us  p99 {jitter[0.99] / 1000:.1f} us  "
+          f"p99.9 {jitter[0.999] / 1000:.1f} us  max {jitter[1.0] / 1000:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Row settle calibration for the PINE100 keyboard matrix.
+#
+# scan() reads the columns right after driving a row, and on a long flex cable (the Tandy 102's is about 150 mm) the
+# columns may not have risen yet, or may still be high from the row before.  This measures, for each row, the shortest
+# busy-wait after driving it that reads correctly every time, and writes it into the layout profile as settle_ns, which
+# the driver applies per row from then on.  Each row is tried at every delay in STEPS_NS, shortest first, SAMPLES times:
+#
+#   1. with every key released, the row must read nothing
+#   2. with a key held on the row, it must read that key, however soon after the row before was let go
+#   3. with a key held on the row before it in the scan, it must read nothing, so the column has fallen in time
+#
+# Each row's setting is the longest of the delays its checks needed, times MARGIN.  The delay is on top of the time the
+# GPIO backend itself takes to drive a pin, so calibrate on the backend the driver uses (PINE_GPIO), with the driver
+# stopped.  The profile's other lines are left as they are.
+#
+#   python3 settle_cal.py /etc/profiles/keyboard_102.json              : measure, then write settle_ns to the profile
+#   python3 settle_cal.py /etc/profiles/keyboard_102.json --dry-run    : measure and print only
+#########################################################################################################################
+
+import os
+import re
+import sys
+import json
+import math
+import argparse
+from time import sleep, monotonic, perf_counter_ns
+from matrix_gpio import open_gpio
+from kbd_engine import load_profile
+
+# Delays tried, in nanoseconds
+STEPS_NS = (0, 250, 500, 1000, 2000, 3000, 5000, 7500, 10000, 15000, 20000, 30000, 50000, 100000)
+# Reads this long after driving a row are taken as the truth, when waiting for keys to be held or released
+REFERENCE_NS = 1000000
+# How long the row before is driven, so its columns are fully charged when it's let go
+CHARGE_NS = 20000
+SAMPLES = 200
+MARGIN = 1.5
+
+
+def busy_wait(ns):
+    deadline = perf_counter_ns() + ns
+    while perf_counter_ns() < deadline:
+        pass
+
+
+# One read of row i, settle_ns after driving it.  If before is a row, it's driven first and let go just before row i,
+# as the scan does.
+def sample(gpio, i, settle_ns, before = None):
+    if before is not None:
+        gpio.drive_row(before, 1)
+        busy_wait(CHARGE_NS)
+        gpio.drive_row(before, 0)
+    gpio.drive_row(i, 1)
+    busy_wait(settle_ns)
+    bits = gpio.read_cols()
+    gpio.drive_row(i, 0)
+    return bits
+
+
+def reference_frame(gpio):
+    width = len(gpio.cols)
+    frame = 0
+    for i in range(len(gpio.rows)):
+        frame |= sample(gpio, i, REFERENCE_NS) << (i * width)
+    return frame
+
+
+# Wait until test(frame) has held for steady seconds, and return the frame
+def wait_for(gpio, test, steady = 0.5):
+    since = None
+    while True:
+        frame = reference_frame(gpio)
+        if not test(frame):
+            since = None
+        elif since is None:
+            since = monotonic()
+        elif monotonic() - since >= steady:
+            return frame
+        sleep(0.02)
+
+
+# The shortest delay in STEPS_NS at which every sample reads expected, None if even the longest doesn't
+def shortest(gpio, i, expected, samples, before = None):
+    for step in STEPS_NS:
+        if all(sample(gpio, i, step, before) == expected for _ in range(samples)):
+            return step
+    return None
+
+
+def calibrate(gpio, profile, samples):
+    rows, width = len(gpio.rows), len(gpio.cols)
+    row_mask = (1 << width) - 1
+    # Delay each of a row's checks passed at, None for one that never passed
+    needed = [{} for _ in range(rows)]
+
+    print("Release every key.")
+    wait_for(gpio, lambda frame: frame == 0)
+    for i in range(rows):
+        needed[i]["released"] = shortest(gpio, i, 0, samples)
+
+    for i in range(rows):
+        key = profile.names.get(profile.base[i * width], "any key")
+        print(f"Hold down {key} (or any one key on row {i}, pin {gpio.rows[i]}) until asked to let go.")
+        frame = wait_for(gpio, lambda frame: frame and not frame & ~(row_mask << (i * width)))
+        held = frame >> (i * width)
+        needed[i]["held"] = shortest(gpio, i, held, samples, before = i - 1 if i else None)
+        if i + 1 < rows:
+            needed[i + 1][f"after row {i}"] = shortest(gpio, i + 1, 0, samples, before = i)
+        print("Let go.")
+        wait_for(gpio, lambda frame: frame == 0)
+
+    settle = []
+    for i, steps in enumerate(needed):
+        failed = [check for check, step in steps.items() if step is None]
+        if failed:
+            raise RuntimeError(f"Row {i} (pin {gpio.rows[i]}) didn't read reliably {', '.join(failed)}, even "
+                               f"{STEPS_NS[-1]} ns after driving it; check the wiring")
+        settle.append(math.ceil(max(steps.values()) * MARGIN))
+        print(f"row {i} pin {gpio.rows[i]:2}: " + ", ".join(f"{check} {step} ns" for check, step in steps.items())
+              + f"  -> {settle[-1]} ns")
+    return settle
+
+
+# Put settle_ns into the profile's text, replacing an old one or after the cols line, so the layout keeps its layout
+def write_settle(path, settle):
+    with open(path) as f:
+        text = f.read()
+    value = json.dumps(settle)
+    if re.search(r'"settle_ns"\s*:', text):
+        text = re.sub(r'("settle_ns"\s*:\s*)\[[^\]]*\]', lambda match: match.group(1) + value, text, count = 1)
+    else:
+        text, found = re.subn(r'^(\s*)"cols"\s*:.*\n', lambda match: f'{match.group(0)}{match.group(1)}"settle_ns": '
+                              f'{value},\n', text, count = 1, flags = re.MULTILINE)
+        if not found:
+            raise ValueError(f"{path} has no \"cols\" line to put settle_ns after")
+    if json.loads(text)["settle_ns"] != settle:
+        raise ValueError(f"Couldn't put settle_ns into {path}")
+    with open(path + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(path + ".tmp", path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Measure each row's settle time and store it in the profile")
+    parser.add_argument("profile", help = "layout profile, e.g. /etc/profiles/keyboard_102.json")
+    parser.add_argument("--samples", type = int, default = SAMPLES, help = f"reads per delay (default {SAMPLES})")
+    parser.add_argument("--dry-run", action = "store_true", help = "print the settle times, don't write the profile")
+    args = parser.parse_args()
+
+    profile = load_profile(args.profile)
+    gpio = open_gpio(profile.rows, profile.cols)
+    try:
+        settle = calibrate(gpio, profile, args.samples)
+    except RuntimeError as err:
+        sys.exit(str(err))
+    finally:
+        gpio.cleanup()
+
+    if args.dry_run:
+        print(f'"settle_ns": {json.dumps(settle)}')
+        return
+    write_settle(args.profile, settle)
+    print(f"Wrote settle_ns to {args.profile}; run kbd_engine.py --compile on it, then restart the driver")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,18 @@
-import evdev
-
-while(True):
-    if 0 in (evdev.InputDevice('/dev/input/event5').leds()):
-        print("NumLock set!")
-    elif (offflag == 0):
-        print("Numlock reset")
-
+#!/usr/bin/python3
 
+# Print the keyboard's NumLock/CapsLock LED changes as they happen:  python3 test_numlock.py ["Tandy 102 Keyboard"]
+# The device is found by name, and read_loop() sleeps until the next event instead of polling leds().
+import sys
+from evdev import InputDevice, list_devices, ecodes as e
 
+name = sys.argv[1] if len(sys.argv) > 1 else "Tandy 102 Keyboard"
+device = next((device for device in map(InputDevice, list_devices()) if device.name == name), None)
+if device is None:
+    sys.exit(f"No input device called {name}")
 
+print(f"{device.path}: NumLock {'set' if e.LED_NUML in device.leds() else 'reset'}")
+for event in device.read_loop():
+    if event.type == e.EV_LED and event.code == e.LED_NUML:
+        print("NumLock set!" if event.value else "Numlock reset")
+    elif event.type == e.EV_LED and event.code == e.LED_CAPSL:
+        print("CapsLock set!" if event.value else "CapsLock reset")
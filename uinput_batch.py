@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+
+#########################################################################################################################
+# Batched writes to the keyboard's uinput device: one write() per frame.
+#
+# python-evdev's UInput.write() is a write() syscall per event, and syn() is one more, so CODE+9 (LEFTSHIFT, LEFTBRACE,
+# SYN_REPORT) is three syscalls and a chord of several keys many more.  BatchWriter has the same write()/syn() calls,
+# but write() only packs a struct input_event into a preallocated buffer and syn() adds the SYN_REPORT and hands the
+# whole frame to the kernel with a single os.write().  uinput takes the events of one write() in order, under its lock,
+# so a frame also can't be split by another thread writing to the same device.
+#
+# open_batch_writer() wraps a device made by led_sync.open_uinput().  Off Linux, for a device without a file descriptor
+# (fake_uinput.py) or with PINE_BATCH=0, it returns the device itself and every event goes through python-evdev.
+#
+#   python3 uinput_batch.py                 : events/s and syscalls per frame, per-event writes against batched ones
+#   python3 uinput_batch.py --uinput        : the same against a real uinput device with python-evdev (needs root)
+#########################################################################################################################
+
+import os
+import sys
+import struct
+import logging
+from time import perf_counter
+
+# struct input_event: struct timeval (uinput ignores it, the input core stamps the event), type, code, value
+INPUT_EVENT = struct.Struct("llHHi")
+EV_SYN = 0
+EV_KEY = 1
+SYN_REPORT = 0
+# Events held before a frame is written out early; a frame with every key changed fits many times over
+CAPACITY = 256
+
+
+class BatchWriter:
+    def __init__(self, fd, capacity = CAPACITY):
+        self.fd = fd
+        self.buffer = bytearray(INPUT_EVENT.size * capacity)
+        self.view = memoryview(self.buffer)
+        self.end = len(self.buffer)
+        self.offset = 0
+        # write() syscalls made, for the benchmark
+        self.writes = 0
+
+    def write(self, etype, code, value):
+        if self.offset == self.end:
+            self.flush()
+        INPUT_EVENT.pack_into(self.buffer, self.offset, 0, 0, etype, code, value)
+        self.offset += INPUT_EVENT.size
+
+    def syn(self):
+        self.write(EV_SYN, SYN_REPORT, 0)
+        self.flush()
+
+    # A write that fails loses the rest of the frame, rather than sending it again in front of the next one
+    def flush(self):
+        written = 0
+        try:
+            while written < self.offset:
+                written += os.write(self.fd, self.view[written:self.offset])
+                self.writes += 1
+        finally:
+            self.offset = 0
+
+
+# A BatchWriter on ui's file descriptor, or ui itself where batching isn't available or is turned off
+def open_batch_writer(ui):
+    if os.environ.get("PINE_BATCH", "1") in ("", "0"):
+        return ui
+    fd = getattr(ui, "fd", None)
+    if fd is None or not sys.platform.startswith("linux"):
+        logging.info("Writing events one at a time through python-evdev")
+        return ui
+    return BatchWriter(fd)
+
+
+# ================= Benchmark ===================
+# Per-event writes on a plain file descriptor, the syscalls python-evdev's UInput.write() and syn() make
+class EventWriter:
+    def __init__(self, fd):
+        self.fd = fd
+        self.writes = 0
+
+    def write(self, etype, code, value):
+        os.write(self.fd, INPUT_EVENT.pack(0, 0, etype, code, value))
+        self.writes += 1
+
+    def syn(self):
+        self.write(EV_SYN, SYN_REPORT, 0)
+
+
+# Frames as (key code, value) events shaped like a plain key, CODE+9 (two keys) and a four-key chord, down and up.  The
+# codes are F13-F16, which nothing is normally bound to, so --uinput doesn't type into whatever has the focus.
+F13 = 183
+FRAMES = [
+    [(F13, 1)], [(F13, 0)],
+    [(F13 + 1, 1), (F13, 1)], [(F13, 0), (F13 + 1, 0)],
+    [(F13, 1), (F13 + 1, 1), (F13 + 2, 1), (F13 + 3, 1)], [(F13 + 3, 0), (F13 + 2, 0), (F13 + 1, 0), (F13, 0)],
+]
+
+
+# Events per second, and write() syscalls per frame for a writer that counts them (None otherwise)
+def bench(writer, rounds):
+    writes = getattr(writer, "writes", 0)
+    events = 0
+    start = perf_counter()
+    for _ in range(rounds):
+        for frame in FRAMES:
+            for code, value in frame:
+                writer.write(EV_KEY, code, value)
+            writer.syn()
+            events += len(frame) + 1
+    seconds = perf_counter() - start
+    if not hasattr(writer, "writes"):
+        return events / seconds, None
+    return events / seconds, (writer.writes - writes) / (rounds * len(FRAMES))
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description = "Compare per-event and batched uinput writes")
+    parser.add_argument("--rounds", type = int, default = 20000, help = "times through the test frames")
+    parser.add_argument("--uinput", action = "store_true", help = "write to a real uinput device through python-evdev")
+    args = parser.parse_args()
+
+    if args.uinput:
+        from evdev import UInput
+        ui = UInput({EV_KEY: range(F13, F13 + 4)}, name = "PINE100 uinput benchmark")
+        writers = {"python-evdev": ui, "batched": BatchWriter(ui.fd)}
+        # UInput doesn't count its writes: one per event, syn included
+        per_event = sum(len(frame) + 1 for frame in FRAMES) / len(FRAMES)
+    else:
+        fd = os.open(os.devnull, os.O_WRONLY)
+        writers = {"per event": EventWriter(fd), "batched": BatchWriter(fd)}
+        per_event = None
+
+    print(f"{'writer':14} {'events/s':>10} {'writes/frame':>13}")
+    for name, writer in writers.items():
+        rate, writes = bench(writer, args.rounds)
+        if writes is None:
+            writes = per_event
+        print(f"{name:14} {rate:10.0f} {writes:13.2f}")
+
+
+if __name__ == "__main__":
+    main()